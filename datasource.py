@@ -5,15 +5,24 @@ from envs import gameoflife
 from envs import minipacman
 
 
-def allocate_datasource(datasource_name):
+# Options for replay-based datasources:
+#   sim_workers: number of simulator processes
+#   samples_per_insert: target ratio of sampled clips to simulated episodes
+#   replay_ring_dir: directory of fixed-capacity memory-mapped replay rings
+def allocate_datasource(datasource_name, sim_workers=0, samples_per_insert=0, replay_ring_dir=None):
+    replay_options = {
+        'sim_workers': sim_workers,
+        'samples_per_insert': samples_per_insert,
+        'replay_ring_dir': replay_ring_dir,
+    }
     if datasource_name == 'sc2_star_intruders':
-        return SC2StarIntruders()
+        return SC2StarIntruders(**replay_options)
     elif datasource_name == 'sc2_star_intruders_variant_a':
-        return SC2StarIntruders('StarIntrudersVariantA')
+        return SC2StarIntruders('StarIntrudersVariantA', **replay_options)
     elif datasource_name == 'sc2_star_intruders_variant_b':
-        return SC2StarIntruders('StarIntrudersVariantB')
+        return SC2StarIntruders('StarIntrudersVariantB', **replay_options)
     elif datasource_name == 'sc2_star_intruders_variant_c':
-        return SC2StarIntruders('StarIntrudersVariantC')
+        return SC2StarIntruders('StarIntrudersVariantC', **replay_options)
     elif datasource_name == 'pong':
         return Pong()
     elif datasource_name == 'gridworld':
@@ -21,7 +30,7 @@ def allocate_datasource(datasource_name):
     elif datasource_name == 'gameoflife':
         return GameOfLife()
     elif datasource_name == 'minipacman':
-        return MiniPacMan()
+        return MiniPacMan(**replay_options)
     msg = 'Failed to find datasource with name {}'.format(datasource_name)
     raise ValueError(msg)
 
@@ -36,10 +45,13 @@ class Datasource():
 
 
 class SC2StarIntruders(Datasource):
-    def __init__(self, map_name=None):
+    def __init__(self, map_name=None, sim_workers=0, samples_per_insert=0, replay_ring_dir=None):
         # global map filename hack
         if map_name:
             sc2_star_intruders.MAP_NAME = map_name
+        sc2_star_intruders.SIM_WORKERS = sim_workers
+        sc2_star_intruders.SAMPLES_PER_INSERT = samples_per_insert
+        sc2_star_intruders.REPLAY_RING_DIR = replay_ring_dir
         self.map_name = map_name
         self.binary_input_channels = sc2_star_intruders.NUM_ACTIONS
         self.scalar_output_channels = sc2_star_intruders.NUM_REWARDS
@@ -102,7 +114,10 @@ class GameOfLife(Datasource):
 
 
 class MiniPacMan(Datasource):
-    def __init__(self):
+    def __init__(self, sim_workers=0, samples_per_insert=0, replay_ring_dir=None):
+        minipacman.SIM_WORKERS = sim_workers
+        minipacman.SAMPLES_PER_INSERT = samples_per_insert
+        minipacman.REPLAY_RING_DIR = replay_ring_dir
         self.binary_input_channels = minipacman.NUM_ACTIONS
         self.scalar_output_channels = minipacman.NUM_REWARDS
         self.conv_input_channels = 3
@@ -112,7 +127,7 @@ class MiniPacMan(Datasource):
         return minipacman.MiniPacManEnv()
 
     def convert_frame(self, state):
-        state = state.transpose((2,0,1))
+        state = minipacman.convert_frame(state)
         return state, state
 
     def get_trajectories(self, *args, **kwargs):
@@ -3,7 +3,6 @@ import numpy as np
 import random
 
 from tqdm import tqdm
-from multi_env import MultiEnvironment
 from gym.spaces.discrete import Discrete
 
 CHANNELS = 3
@@ -91,8 +90,110 @@ class BetterPongEnv():
         return self.state, reward, done, info
 
 
+# A batch of BetterPongEnv games, stored as one (batch_size,) array per state variable
+# Physics is applied to every game at once with masked array operations, and all
+# frames are rasterized together into a single preallocated buffer.
+class BetterPongVecEnv():
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.action_space = Discrete(4)
+        self.state = np.zeros((batch_size, CHANNELS, GAME_SIZE, GAME_SIZE), dtype=bool)
+        self.reset()
+
+    def reset(self):
+        B = self.batch_size
+        self.left_y = np.random.randint(MARGIN_Y, 64 - MARGIN_Y, size=B)
+        self.right_y = np.random.randint(MARGIN_Y, 64 - MARGIN_Y, size=B)
+        self.ball_x = np.random.randint(0 + MARGIN_X, 64 - MARGIN_X, size=B)
+        self.ball_y = np.random.randint(0 + MARGIN_Y, 64 - MARGIN_Y, size=B)
+        self.ball_velocity_x = np.random.choice([-3, -2, 2, +3], size=B)
+        self.ball_velocity_y = np.random.choice([-3, -2, 2, +3], size=B)
+        return self.render()
+
+    # Step every game with its own action; same rules as BetterPongEnv.step
+    # If out is given, the new frames are rendered into it instead of self.state
+    def step(self, actions, out=None):
+        a = np.asarray(actions)
+
+        # Move the red paddle up/down
+        self.right_y -= 3 * (a == 0)
+        self.right_y += 3 * (a == 1)
+        np.clip(self.right_y, 0, GAME_SIZE, out=self.right_y)
+
+        # Move the blue paddle up/down
+        self.left_y -= 3 * (a == 2)
+        self.left_y += 3 * (a == 3)
+        np.clip(self.left_y, 0, GAME_SIZE, out=self.left_y)
+
+        # The ball moves and interacts with the paddles
+        self.ball_x += self.ball_velocity_x
+        self.ball_y += self.ball_velocity_y
+
+        # Ball bouncing from the paddles
+        bounce_right = GAME_SIZE - MARGIN_X - BALL_RADIUS - PADDLE_WIDTH
+        bounce_left = MARGIN_X + BALL_RADIUS + PADDLE_WIDTH
+        bounce = ((bounce_right <= self.ball_x) & (self.ball_x <= bounce_right + BALL_RADIUS)
+                  & (self.ball_velocity_x > 0)
+                  & (self.right_y - PADDLE_HEIGHT <= self.ball_y) & (self.ball_y <= self.right_y + PADDLE_HEIGHT))
+        self.ball_velocity_x[bounce] *= -1
+        bounce = ((bounce_left - BALL_RADIUS <= self.ball_x) & (self.ball_x <= bounce_left)
+                  & (self.ball_velocity_x < 0)
+                  & (self.left_y - PADDLE_HEIGHT <= self.ball_y) & (self.ball_y <= self.left_y + PADDLE_HEIGHT))
+        self.ball_velocity_x[bounce] *= -1
+
+        # Ball bounces off the top and bottom
+        self.ball_velocity_y[(self.ball_y >= GAME_SIZE - 2) & (self.ball_velocity_y > 0)] *= -1
+        self.ball_velocity_y[(self.ball_y <= 2) & (self.ball_velocity_y < 0)] *= -1
+
+        # If the ball goes out of the court, a reward is generated
+        dones = np.zeros(self.batch_size, dtype=bool)
+        rewards = np.zeros(self.batch_size)
+        # Blue player scores
+        scored = (self.ball_x >= GAME_SIZE) & (self.ball_velocity_x > 0)
+        rewards[scored] = 1
+        self.ball_velocity_x[scored] *= -1
+        # Red player scores
+        scored = (self.ball_x <= 0) & (self.ball_velocity_x < 0)
+        rewards[scored] = -1
+        self.ball_velocity_x[scored] *= -1
+
+        states = self.render(out)
+        return states, rewards, dones, {}
+
+    def render(self, out=None):
+        if out is None:
+            out = self.state
+        return render_states(self.left_y, self.right_y, self.ball_x, self.ball_y, out)
+
+
+# Rasterize a batch of games into out, a (batch_size, CHANNELS, GAME_SIZE, GAME_SIZE) bool array
+def render_states(left_y, right_y, ball_x, ball_y, out):
+    out[:] = False
+    # Blue paddle on the left, red on the right
+    draw_rects(out, np.full_like(left_y, MARGIN_X), left_y, PADDLE_WIDTH, PADDLE_HEIGHT, color=2)
+    draw_rects(out, np.full_like(right_y, GAME_SIZE - MARGIN_X), right_y, PADDLE_WIDTH, PADDLE_HEIGHT, color=0)
+
+    # Green ball (note that you must see multiple frames to know velocity)
+    draw_rects(out, ball_x, ball_y, BALL_RADIUS, BALL_RADIUS, color=1)
+    return out
+
+
+# Batched draw_rect: one rectangle per frame, drawn as the outer product of row and column masks
+def draw_rects(pixels, center_x, center_y, width, height, color):
+    batch_size, img_channels, img_height, img_width = pixels.shape
+    left = np.maximum(center_x - width, 0)
+    right = np.minimum(center_x + width, img_width - 1)
+    top = np.maximum(center_y - height, 0)
+    bottom = np.minimum(center_y + height, img_height - 1)
+    rows = np.arange(img_height)
+    cols = np.arange(img_width)
+    row_mask = (rows >= top[:, None]) & (rows < bottom[:, None])
+    col_mask = (cols >= left[:, None]) & (cols < right[:, None])
+    pixels[:, color] |= row_mask[:, :, None] & col_mask[:, None, :]
+
+
 def render_state(left_y, right_y, ball_x, ball_y, ball_velocity_x, ball_velocity_y):
-    state = np.ones((CHANNELS, GAME_SIZE, GAME_SIZE)) * .0
+    state = np.zeros((CHANNELS, GAME_SIZE, GAME_SIZE), dtype=bool)
 
     # Blue paddle on the left, red on the right
     draw_rect(state, MARGIN_X, left_y, PADDLE_WIDTH, PADDLE_HEIGHT, color=2)
@@ -109,31 +210,27 @@ def draw_rect(pixels, center_x, center_y, width, height, color):
     right = min(center_x + width, img_width - 1)
     top = max(center_y - height, 0)
     bottom = min(center_y + height, img_height - 1)
-    pixels[color, top:bottom, left:right] = 1
+    pixels[color, top:bottom, left:right] = True
 
 
 # Note: In this env, training=True has no effect. All trajectories are test set trajectories.
 def get_trajectories(batch_size=32, timesteps=10, policy='random', random_start=False, training=False):
-    envs = MultiEnvironment([BetterPongEnv() for _ in range(batch_size)])
-    t_states, t_rewards, t_dones, t_actions = [], [], [], []
+    envs = BetterPongVecEnv(batch_size)
+    num_actions = envs.action_space.n
+    # Outputs are preallocated as (batch_size, timesteps, ...) and filled in place
+    states = np.zeros((batch_size, timesteps, CHANNELS, GAME_SIZE, GAME_SIZE), dtype=bool)
+    rewards = np.zeros((batch_size, timesteps, NUM_REWARDS))
+    dones = np.zeros((batch_size, timesteps), dtype=bool)
+    actions = np.zeros((batch_size, timesteps), dtype=int)
     # Initial actions/stats
-    actions = np.random.randint(envs.action_space.n, size=(batch_size,))
+    a = np.random.randint(num_actions, size=(batch_size,))
     for t in range(timesteps):
-        states, rewards, dones, _ = envs.step(actions)
-        rewards = [rewards]
+        _, rewards[:, t, 0], dones[:, t], _ = envs.step(a, out=states[:, t])
         if policy == 'random':
-            actions = np.random.randint(envs.action_space.n, size=(batch_size,))
+            a = np.random.randint(num_actions, size=(batch_size,))
         if policy == 'repeat':
-            actions = [i % envs.action_space.n for i in range(batch_size)]
-        t_states.append(states)
-        t_rewards.append(rewards)
-        t_dones.append(dones)
-        t_actions.append(actions)
-    # Reshape to (batch_size, timesteps, ...)
-    states = np.swapaxes(t_states, 0, 1)
-    rewards = np.swapaxes(t_rewards, 0, 1)
-    dones = np.swapaxes(t_dones, 0, 1)
-    actions = np.swapaxes(t_actions, 0, 1)
+            a = np.arange(batch_size) % num_actions
+        actions[:, t] = a
     return states, rewards, dones, actions
 
 
@@ -181,7 +278,7 @@ if __name__ == '__main__':
     import imutil
     vid = imutil.Video('realpong.mp4', framerate=5)
     for state, action, reward in zip(states[0], actions[0], rewards[0]):
-        pixels = np.transpose(state, (1, 2, 0))
+        pixels = np.transpose(state, (1, 2, 0)).astype(float)
         caption = "Prev. Action {} Prev Reward {}".format(action, reward)
         vid.write_frame(pixels, img_padding=8, resize_to=(512,512), caption=caption)
     vid.finish()
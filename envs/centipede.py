@@ -1,3 +1,4 @@
+import atexit
 import time
 import numpy as np
 import random
@@ -69,6 +70,7 @@ class HeuristicPolicy():
 
 MAX_BATCH_SIZE = 32
 envs = MultiEnvironment([GameEnv() for _ in range(MAX_BATCH_SIZE)])
+atexit.register(envs.close)
 states = envs.reset()
 def get_trajectories(batch_size=32, timesteps=10, policy=None, random_start=False):
     global states
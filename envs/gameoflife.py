@@ -2,7 +2,6 @@ import time
 import numpy as np
 import random
 
-from multi_env import MultiEnvironment
 from gym.spaces.discrete import Discrete
 
 CHANNELS = 1
@@ -10,6 +9,10 @@ GAME_SIZE = 64
 NUM_ACTIONS = 1
 NUM_REWARDS = 1
 PREHEAT_STEPS = 0
+# Packed boards store each row as one little-endian 64-bit word
+PACKED_DTYPE = np.dtype('<u8')
+SHIFT_1 = np.uint64(1)
+SHIFT_63 = np.uint64(63)
 
 
 # Conway's Game of Life
@@ -21,45 +24,99 @@ class Env():
         self.action_space = Discrete(1)
 
     def reset(self, p=0.5):
-        # One row and column of circular padding for toroidal topology
-        self.state = np.random.random((GAME_SIZE, GAME_SIZE)) > p
-        for _ in range(PREHEAT_STEPS):
-            self.step(0)
+        self.life = BatchedLife(1)
+        self.life.reset(p)
+        self.state = self.life.unpack()[0]
+        return np.expand_dims(self.state, 0)
 
     def step(self, a):
         # Ignore input actions; Life is a zero-player game
-        from scipy.signal import convolve2d
-
-        # Step forward in time
-        kernel = np.ones((3, 3))
-        kernel[1, 1] = 0
-        nbrs_count = convolve2d(self.state, kernel, mode='same', boundary='wrap')
-        self.state = ((nbrs_count == 3) | (self.state & (nbrs_count == 2)))
+        self.life.step()
+        self.state = self.life.unpack()[0]
         reward = 0
         done = False
         info = {}
-        output_state = np.expand_dims(self.state, 0).astype(np.float)
+        output_state = np.expand_dims(self.state, 0)
         return output_state, reward, done, info
 
 
+# Bit-parallel Game of Life on a batch of toroidal boards
+# Each board row is packed into one uint64 (bit j is column j), so a batch of
+# boards is a (batch_size, GAME_SIZE) array and one generation of every board
+# is a few dozen bitwise operations on whole rows.
+class BatchedLife():
+    def __init__(self, batch_size):
+        assert GAME_SIZE == 64, 'BatchedLife packs each row into a single 64-bit word'
+        self.batch_size = batch_size
+        self.rows = np.zeros((batch_size, GAME_SIZE), dtype=PACKED_DTYPE)
+
+    def reset(self, p=0.5):
+        self.rows = pack_boards(np.random.random((self.batch_size, GAME_SIZE, GAME_SIZE)) > p)
+        for _ in range(PREHEAT_STEPS):
+            self.step()
+
+    def step(self):
+        self.rows = life_step(self.rows)
+        return self.rows
+
+    # Advance timesteps generations, returning (batch_size, timesteps, GAME_SIZE) packed boards
+    def simulate(self, timesteps):
+        packed = np.zeros((self.batch_size, timesteps, GAME_SIZE), dtype=PACKED_DTYPE)
+        for t in range(timesteps):
+            packed[:, t] = self.step()
+        return packed
+
+    def unpack(self):
+        return unpack_boards(self.rows)
+
+
+# (..., GAME_SIZE, GAME_SIZE) bool boards to (..., GAME_SIZE) packed rows
+def pack_boards(boards):
+    packed = np.packbits(boards, axis=-1, bitorder='little')
+    return np.ascontiguousarray(packed).view(PACKED_DTYPE)[..., 0]
+
+
+# (..., GAME_SIZE) packed rows to (..., GAME_SIZE, GAME_SIZE) bool boards
+def unpack_boards(packed):
+    packed = np.ascontiguousarray(packed, dtype=PACKED_DTYPE)
+    bytes_ = packed[..., None].view(np.uint8)
+    return np.unpackbits(bytes_, axis=-1, bitorder='little').view(bool)
+
+
+# One generation of Life for (batch_size, GAME_SIZE) packed rows
+def life_step(rows):
+    # Neighbor rows wrap around vertically, neighbor columns are bit rotations
+    up = np.roll(rows, 1, axis=-1)
+    down = np.roll(rows, -1, axis=-1)
+    neighbors = [up, down]
+    for x in (rows, up, down):
+        neighbors.append((x << SHIFT_1) | (x >> SHIFT_63))
+        neighbors.append((x >> SHIFT_1) | (x << SHIFT_63))
+
+    # Count neighbors in every cell at once with a bit-sliced adder
+    # s0 and s1 are the low bits of the count, s2 is set once the count reaches 4
+    s0 = np.zeros_like(rows)
+    s1 = np.zeros_like(rows)
+    s2 = np.zeros_like(rows)
+    for n in neighbors:
+        carry = s0 & n
+        s0 ^= n
+        s2 |= s1 & carry
+        s1 ^= carry
+
+    # A cell lives with exactly 3 neighbors, or with 2 if it is already alive
+    return s1 & ~s2 & (s0 | rows)
+
+
 def get_trajectories(batch_size=32, timesteps=10, policy='random', random_start=False, training=False):
-    envs = MultiEnvironment([Env() for _ in range(batch_size)])
-    t_states, t_rewards, t_dones, t_actions = [], [], [], []
-    # Initial actions/stats
-    actions = np.random.randint(envs.action_space.n, size=(batch_size,))
-    for t in range(timesteps):
-        states, rewards, dones, _ = envs.step(actions)
-        rewards = [rewards]
-        actions = np.random.randint(envs.action_space.n, size=(batch_size,))
-        t_states.append(states)
-        t_rewards.append(rewards)
-        t_dones.append(dones)
-        t_actions.append(actions)
-    # Reshape to (batch_size, timesteps, ...)
-    states = np.swapaxes(t_states, 0, 1)
-    rewards = np.swapaxes(t_rewards, 0, 1)
-    dones = np.swapaxes(t_dones, 0, 1)
-    actions = np.swapaxes(t_actions, 0, 1)
+    life = BatchedLife(batch_size)
+    life.reset()
+    # Boards are simulated packed, then unpacked into (batch_size, timesteps, 1, 64, 64) at once
+    states = np.expand_dims(unpack_boards(life.simulate(timesteps)), 2)
+    rewards = np.zeros((batch_size, timesteps, NUM_REWARDS))
+    dones = np.zeros((batch_size, timesteps), dtype=bool)
+    # Ignore input actions; Life is a zero-player game
+    actions = np.random.randint(NUM_ACTIONS, size=(batch_size, timesteps))
     return states, rewards, dones, actions
 
 
@@ -68,7 +125,7 @@ if __name__ == '__main__':
     import imutil
     vid = imutil.Video('gameoflife.mp4', framerate=5)
     for state, action, reward in zip(states[0], actions[0], rewards[0]):
-        pixels = np.transpose(state, (1, 2, 0))
+        pixels = np.transpose(state, (1, 2, 0)).astype(float)
         caption = "Prev. Action {} Prev Reward {}".format(action, reward)
         vid.write_frame(pixels, img_padding=8, resize_to=(512,512), caption=caption)
     vid.finish()
@@ -1,6 +1,8 @@
 import time
 import numpy as np
 import random
+import atexit
+import threading
 
 from multi_env import MultiEnvironment
 from gym.spaces.discrete import Discrete
@@ -58,7 +60,7 @@ class Env():
 
 
 def render_state(ball_x, ball_y):
-    state = np.ones((CHANNELS, GAME_SIZE, GAME_SIZE)) * .0
+    state = np.zeros((CHANNELS, GAME_SIZE, GAME_SIZE), dtype=bool)
     # Ball moves around
     draw_rect(state, ball_x, ball_y, BALL_RADIUS, BALL_RADIUS, color=1)
     return state
@@ -70,30 +72,48 @@ def draw_rect(pixels, center_x, center_y, width, height, color):
     right = min(center_x + width, img_width - 1)
     top = max(center_y - height, 0)
     bottom = min(center_y + height, img_height - 1)
-    pixels[color, top:bottom, left:right] = 1
+    pixels[color, top:bottom, left:right] = True
+
+
+# One persistent MultiEnvironment per batch size, reset at the start of each batch
+# Callers on different threads (eg. the prefetcher and evaluation) take turns
+# with each one through its lock; all of them are closed at exit
+multi_envs = {}
+multi_envs_lock = threading.Lock()
+
+
+def get_multi_env(batch_size):
+    with multi_envs_lock:
+        if batch_size not in multi_envs:
+            envs = MultiEnvironment([Env() for _ in range(batch_size)])
+            atexit.register(envs.close)
+            multi_envs[batch_size] = (envs, threading.Lock())
+        return multi_envs[batch_size]
 
 
 def get_trajectories(batch_size=32, timesteps=10, policy='random', random_start=False, training=True):
-    envs = MultiEnvironment([Env() for _ in range(batch_size)])
-    t_states, t_rewards, t_dones, t_actions = [], [], [], []
+    envs, lock = get_multi_env(batch_size)
+    with lock:
+        return simulate_trajectories(envs, batch_size, timesteps, policy)
+
+
+def simulate_trajectories(envs, batch_size, timesteps, policy):
+    envs.reset()
+    num_actions = envs.action_space.n
+    # Outputs are preallocated as (batch_size, timesteps, ...) and filled in place
+    states = np.zeros((batch_size, timesteps) + envs.state_shape, dtype=envs.state_dtype)
+    rewards = np.zeros((batch_size, timesteps, NUM_REWARDS))
+    dones = np.zeros((batch_size, timesteps), dtype=bool)
+    actions = np.zeros((batch_size, timesteps), dtype=int)
     # Initial actions/stats
-    actions = np.random.randint(envs.action_space.n, size=(batch_size,))
+    a = np.random.randint(num_actions, size=(batch_size,))
     for t in range(timesteps):
-        states, rewards, dones, _ = envs.step(actions)
-        rewards = [rewards]
+        envs.step(a, out=(states[:, t], rewards[:, t, 0], dones[:, t]))
         if policy == 'random':
-            actions = np.random.randint(envs.action_space.n, size=(batch_size,))
+            a = np.random.randint(num_actions, size=(batch_size,))
         if policy == 'repeat':
-            actions = [i % envs.action_space.n for i in range(batch_size)]
-        t_states.append(states)
-        t_rewards.append(rewards)
-        t_dones.append(dones)
-        t_actions.append(actions)
-    # Reshape to (batch_size, timesteps, ...)
-    states = np.swapaxes(t_states, 0, 1)
-    rewards = np.swapaxes(t_rewards, 0, 1)
-    dones = np.swapaxes(t_dones, 0, 1)
-    actions = np.swapaxes(t_actions, 0, 1)
+            a = np.arange(batch_size) % num_actions
+        actions[:, t] = a
     return states, rewards, dones, actions
 
 
@@ -102,7 +122,7 @@ if __name__ == '__main__':
     import imutil
     vid = imutil.Video('gridworld.mp4', framerate=5)
     for state, action, reward in zip(states[0], actions[0], rewards[0]):
-        pixels = np.transpose(state, (1, 2, 0))
+        pixels = np.transpose(state, (1, 2, 0)).astype(float)
         caption = "Prev. Action {} Prev Reward {}".format(action, reward)
         vid.write_frame(pixels, img_padding=8, resize_to=(512,512), caption=caption)
     vid.finish()
@@ -8,6 +8,8 @@ from threading import Thread
 import imutil
 import gym
 
+from replay_buffer import ReplayBuffer, quantize_frame
+
 REPLAY_BUFFER_LEN = 100
 MIN_REPLAY_BUFFER_LEN = 4
 MAX_TRAJECTORY_LEN = 200
@@ -18,20 +20,22 @@ NUM_ACTIONS = 6
 NUM_REWARDS = 1
 RGB_SIZE = 64
 
-replay_buffer = []
+replay_buffer = ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN)
 initialized = False
 simulation_iters = 0
 env = None
 policy = None
+sim_thread = None
 
 
 def init():
     global env
     global initialized
+    global sim_thread
     env = gym.make(ENV_NAME)
-    thread = Thread(target=play_game_thread)
-    thread.daemon = True  # hack to kill on ctrl+C
-    thread.start()
+    sim_thread = Thread(target=play_game_thread)
+    sim_thread.daemon = True  # hack to kill on ctrl+C
+    sim_thread.start()
     initialized = True
 
 
@@ -55,76 +59,44 @@ def simulate_to_replay_buffer(batch_size):
 
 
 def play_episode(env, policy):
-    states, rewards, actions = [], [], []
+    # Each timestep is written straight into the replay buffer's storage
+    slot = replay_buffer.start_episode()
     state = env.reset()
     for _ in range(BURN_STATES_BEFORE_START):
         state, _, _, _ = env.step(action=0)
-    reward = [0]
+    reward = [0.]
     done = False
+    t = 0
     while True:
         action = policy(state)
         state = convert_atari_frame(state)
-        states.append(state)
-        rewards.append(reward)
-        actions.append(action)
-        if len(states) >= MAX_TRAJECTORY_LEN:
+        replay_buffer.write_timestep(slot, t, (state, reward, action))
+        t += 1
+        if t >= MAX_TRAJECTORY_LEN:
             done = True
         if done:
             break
         state, reward, done, info = env.step(action)
         reward = [reward]
-    trajectory = (np.array(states), np.array(rewards), np.array(actions))
-    add_to_replay_buffer(trajectory)
-
-
-def add_to_replay_buffer(episode):
-    if len(replay_buffer) < REPLAY_BUFFER_LEN:
-        replay_buffer.append(episode)
-    else:
-        idx = np.random.randint(1, REPLAY_BUFFER_LEN)
-        replay_buffer[idx] = episode
+    replay_buffer.finish_episode(slot, t)
 
 
 def get_trajectories(batch_size=8, timesteps=10, random_start=True):
     if not initialized:
         init()
 
-    # Run the game and add new episodes into the replay buffer
-    while len(replay_buffer) < MIN_REPLAY_BUFFER_LEN:
+    if not sim_thread.is_alive():
+        print('Error: Simulator thread has died!')
+        raise Exception('Simulator thread crashed')
+
+    # Wake up as soon as the simulator has added enough episodes to the replay buffer
+    while not replay_buffer.wait_for_episodes(MIN_REPLAY_BUFFER_LEN, timeout=1):
         print('Waiting for replay buffer to fill, buffer size {}/{}...'.format(
             len(replay_buffer), MIN_REPLAY_BUFFER_LEN))
-        time.sleep(1)
-
-    # Sample episodes from the replay buffer
-    states_batch, rewards_batch, dones_batch, actions_batch = [], [], [], []
-    for batch_idx in range(batch_size):
-        # Accumulate trajectory clips
-        states, rewards, actions = [], [], []
-        timesteps_remaining = timesteps
-        dones = []
-        while timesteps_remaining > 0:
-            selected_states, selected_rewards, selected_actions = random.choice(replay_buffer)
-            if random_start:
-                start_idx = np.random.randint(0, len(selected_states) - 3)
-            else:
-                start_idx = 0
-            end_idx = min(start_idx + timesteps_remaining, len(selected_states) - 1)
-            duration = end_idx - start_idx
-            states.extend(selected_states[start_idx:end_idx])
-            rewards.extend(selected_rewards[start_idx:end_idx])
-            actions.extend(selected_actions[start_idx:end_idx])
-            dones.extend([False for _ in range(duration - 1)] + [True])
-            timesteps_remaining -= duration
-
-        states_batch.append(np.array(states))  # BHWC
-        rewards_batch.append(np.array(rewards))
-        dones_batch.append(np.array(dones))
-        actions_batch.append(np.array(actions))
-    states = np.array(states_batch)
+
+    # Sample clips from the replay buffer
+    states, rewards, actions, dones = replay_buffer.sample(batch_size, timesteps, random_start)
     rgb_states = states
-    rewards = np.array(rewards_batch)
-    dones = np.array(dones_batch)
-    actions = np.array(actions_batch)
     return states, rgb_states, rewards, dones, actions
 
 
@@ -135,7 +107,7 @@ def convert_atari_frame(state, width=64, height=64):
 
     state = imutil.get_pixels(state, width, height)
     state = state.transpose((2,0,1))
-    return state
+    return quantize_frame(state)
 
 
 if __name__ == '__main__':
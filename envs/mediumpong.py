@@ -144,6 +144,7 @@ def get_trajectories(batch_size=32, timesteps=10, policy='random'):
         t_rewards.append(rewards)
         t_dones.append(dones)
         t_actions.append(actions)
+    envs.close()
     # Reshape to (batch_size, timesteps, ...)
     states = np.swapaxes(t_states, 0, 1)
     rewards = np.swapaxes(t_rewards, 0, 1)
@@ -1,3 +1,4 @@
+import os
 import sys
 import math
 import random
@@ -8,6 +9,8 @@ from threading import Thread
 import imutil
 import gym
 
+from replay_buffer import ReplayBuffer, RateLimiter, timestep_spec, quantize_frame, start_simulator_processes
+
 
 REPLAY_BUFFER_LEN = 50
 MIN_REPLAY_BUFFER_LEN = 4
@@ -16,14 +19,21 @@ MAX_EPISODES_PER_ENVIRONMENT = 500
 NUM_ACTIONS = 5
 NUM_REWARDS = 2
 NO_OP_ACTION = 0
-
-replay_buffer_training = []
-replay_buffer_testing = []
+# Number of simulator processes (0 simulates in a thread of the training process)
+SIM_WORKERS = 0
+# Target ratio of sampled clips to simulated episodes (0 disables rate limiting)
+SAMPLES_PER_INSERT = 0
+# Directory of memory-mapped replay rings that later runs reopen (None keeps episodes in memory)
+REPLAY_RING_DIR = None
+
+replay_buffer_training = ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN)
+replay_buffer_testing = ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN)
 initialized = False
 simulation_iters = 0
 env = None
 policy = None
-sim_thread = None
+sim_workers = []
+rate_limiter = None
 
 
 from gym_minipacman.envs.minipacman_env import MiniPacman, ALE
@@ -50,14 +60,43 @@ def make_env(*args, **kwargs):
 def init():
     global env
     global initialized
-    global sim_thread
-    env = make_env()
-    sim_thread = Thread(target=play_game_thread)
-    sim_thread.daemon = True  # hack to kill on ctrl+C
-    sim_thread.start()
+    global sim_workers
+    global rate_limiter
+    global replay_buffer_training
+    global replay_buffer_testing
+    if SAMPLES_PER_INSERT > 0:
+        rate_limiter = RateLimiter(SAMPLES_PER_INSERT, MIN_REPLAY_BUFFER_LEN, shared=SIM_WORKERS > 0)
+    if SIM_WORKERS > 0 or REPLAY_RING_DIR:
+        # Simulator processes write into replay buffers in shared memory or on disk
+        spec = timestep_spec(probe_timestep()) if SIM_WORKERS > 0 else None
+        replay_buffer_training = allocate_replay_buffer('training', spec)
+        replay_buffer_testing = allocate_replay_buffer('testing', spec)
+    if SIM_WORKERS > 0:
+        sim_workers = start_simulator_processes(simulator_process, SIM_WORKERS)
+    else:
+        env = make_env()
+        sim_thread = Thread(target=play_game_thread)
+        sim_thread.daemon = True  # hack to kill on ctrl+C
+        sim_thread.start()
+        sim_workers = [sim_thread]
     initialized = True
 
 
+def allocate_replay_buffer(name, spec):
+    shared = SIM_WORKERS > 0
+    directory = os.path.join(REPLAY_RING_DIR, name) if REPLAY_RING_DIR else None
+    return ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN, spec=spec, shared=shared, directory=directory)
+
+
+def simulator_process(worker_idx):
+    global env
+    # Forked workers would otherwise all share the parent's random state
+    np.random.seed()
+    random.seed()
+    env = make_env()
+    play_game_thread()
+
+
 def play_game_thread():
     global env
     while True:
@@ -67,7 +106,7 @@ def play_game_thread():
                 simulation_iters, len(replay_buffer_training), len(replay_buffer_testing)))
         if simulation_iters > 0 and simulation_iters % MAX_EPISODES_PER_ENVIRONMENT == 0:
             del env
-            init()
+            env = make_env()
 
 
 def default_policy(*args, **kwargs):
@@ -82,90 +121,72 @@ def simulate_to_replay_buffer(batch_size):
     if policy is None:
         policy = default_policy
     for _ in range(batch_size):
-        play_episode(env, policy)
+        replay_buffer = select_replay_buffer()
+        # Only training episodes count toward the samples-per-insert ratio:
+        # the training loop never samples the held-out test buffer
+        if rate_limiter and replay_buffer is replay_buffer_training:
+            rate_limiter.await_insert()
+        play_episode(env, policy, replay_buffer)
         simulation_iters += 1
 
 
-def play_episode(env, policy):
-    states, rewards, actions = [], [], []
+def play_episode(env, policy, replay_buffer):
+    # Each timestep is written straight into the replay buffer's storage
+    slot = replay_buffer.start_episode()
     state = env.reset()
     reward = np.zeros(NUM_REWARDS)
     done = False
+    t = 0
     while True:
         action = policy(state)
         state = convert_frame(state)
-        states.append(state)
-        rewards.append(reward)
-        actions.append(action)
-        if len(states) >= MAX_TRAJECTORY_LEN:
+        replay_buffer.write_timestep(slot, t, (state, reward, action))
+        t += 1
+        if t >= MAX_TRAJECTORY_LEN:
             done = True
         if done:
             break
         state, reward_sum, _, info = env.step(action)
         reward[0] = max(0, reward_sum)
         reward[1] = min(0, reward_sum)
-    trajectory = (np.array(states), np.array(rewards), np.array(actions))
-    add_to_replay_buffer(trajectory)
-    time.sleep(1)
+    replay_buffer.finish_episode(slot, t)
 
 
-def add_to_replay_buffer(episode, test_set_holdout=0.20):
-    replay_buffer = replay_buffer_training if np.random.random() > test_set_holdout else replay_buffer_testing
+# A timestep like those written by play_episode, to allocate shared replay buffers
+def probe_timestep():
+    env = make_env()
+    state = convert_frame(env.reset())
+    return (state, np.zeros(NUM_REWARDS), env.action_space.sample())
 
-    if len(replay_buffer) < REPLAY_BUFFER_LEN:
-        replay_buffer.append(episode)
-    else:
-        idx = np.random.randint(0, REPLAY_BUFFER_LEN)
-        replay_buffer[idx] = episode
+
+def select_replay_buffer(test_set_holdout=0.20):
+    return replay_buffer_training if np.random.random() > test_set_holdout else replay_buffer_testing
 
 
 def get_trajectories(batch_size=8, timesteps=10, random_start=True, training=True):
     if not initialized:
         init()
 
-    if not sim_thread.is_alive():
-        print('Error: Simulator thread has died!')
-        raise Exception('Simulator thread crashed')
+    if not all(worker.is_alive() for worker in sim_workers):
+        print('Error: Simulator worker has died!')
+        raise Exception('Simulator worker crashed')
 
     replay_buffer = replay_buffer_training if training else replay_buffer_testing
 
-    # Run the game and add new episodes into the replay buffer
-    while len(replay_buffer) < MIN_REPLAY_BUFFER_LEN:
+    # Wake up as soon as the simulator has added enough episodes to the replay buffer
+    while not replay_buffer.wait_for_episodes(MIN_REPLAY_BUFFER_LEN, timeout=1):
         print('Waiting for replay buffer to fill, buffer size {}/{}...'.format(
             len(replay_buffer), MIN_REPLAY_BUFFER_LEN))
-        time.sleep(1)
-
-    # Sample episodes from the replay buffer
-    states_batch, rewards_batch, dones_batch, actions_batch = [], [], [], []
-    for batch_idx in range(batch_size):
-        # Accumulate trajectory clips
-        states, rewards, actions = [], [], []
-        timesteps_remaining = timesteps
-        dones = []
-        while timesteps_remaining > 0:
-            selected_states, selected_rewards, selected_actions = random.choice(replay_buffer)
-            if random_start:
-                start_idx = np.random.randint(0, len(selected_states) - 3)
-            else:
-                start_idx = 0
-            end_idx = min(start_idx + timesteps_remaining, len(selected_states) - 1)
-            duration = end_idx - start_idx
-            states.extend(selected_states[start_idx:end_idx])
-            rewards.extend(selected_rewards[start_idx:end_idx])
-            actions.extend(selected_actions[start_idx:end_idx])
-            dones.extend([False for _ in range(duration - 1)] + [True])
-            timesteps_remaining -= duration
-
-        # feature_map, reward_vec, done_vec, actions_vec
-        states_batch.append(np.array(states))  # BHWC
-        rewards_batch.append(np.array(rewards))
-        dones_batch.append(np.array(dones))
-        actions_batch.append(np.array(actions))
-    return np.array(states_batch), np.array(rewards_batch), np.array(dones_batch), np.array(actions_batch)
+
+    # Sample clips from the replay buffer, at the rate set by the rate limiter
+    if rate_limiter and training:
+        rate_limiter.await_sample(batch_size)
+    states, rewards, actions, dones = replay_buffer.sample(batch_size, timesteps, random_start)
+    return states, rewards, dones, actions
 
 
 def convert_frame(state):
-    return state.transpose((2, 0, 1)).copy()
+    return quantize_frame(state.transpose((2, 0, 1)))
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -5,13 +5,14 @@ import time
 import numpy as np
 
 from sc2env.environments.micro_battle import MicroBattleEnvironment
+from replay_buffer import ReplayBuffer
 
 REPLAY_FACTOR = 8
 REPLAY_BUFFER_LEN = 500
 MAX_TRAJECTORY_LEN = 100
 MAX_EPISODES_PER_ENVIRONMENT = 500
 NUM_ACTIONS = 2
-replay_buffer = []
+replay_buffer = ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN)
 env = None
 simulation_iters = 0
 
@@ -33,38 +34,29 @@ def simulate_to_replay_buffer(batch_size):
 
 
 def play_episode(env, policy):
-    states, rewards, actions = [], [], []
+    # Each timestep is written straight into the replay buffer's storage
+    slot = replay_buffer.start_episode()
     state = env.reset()
     # hack: skip first few steps
     for _ in range(3):
         state, _, _, _ = env.step(0)
-    reward = 0
+    reward = 0.
     done = False
+    t = 0
     while True:
         action = policy()
         state = state[3]  # Rendered game pixels
         state = state.transpose((2,0,1))  # HWC -> CHW
-        state = state * (1/255)  # [0,1]
-        state = state[:,::2,::2]
-        states.append(state)
-        rewards.append(reward)
-        actions.append(action)
-        if len(states) >= MAX_TRAJECTORY_LEN:
-            print('Warning: ending trajectory at {} timesteps'.format(len(states)))
+        state = np.asarray(state[:,::2,::2], dtype=np.uint8)  # 0-255, scaled on the device
+        replay_buffer.write_timestep(slot, t, (state, reward, action))
+        t += 1
+        if t >= MAX_TRAJECTORY_LEN:
+            print('Warning: ending trajectory at {} timesteps'.format(t))
             done = True
         if done:
             break
         state, reward, done, info = env.step(action)
-    trajectory = (np.array(states), np.array(rewards), np.array(actions))
-    add_to_replay_buffer(trajectory)
-
-
-def add_to_replay_buffer(episode):
-    if len(replay_buffer) < REPLAY_BUFFER_LEN:
-        replay_buffer.append(episode)
-    else:
-        idx = np.random.randint(1, REPLAY_BUFFER_LEN)
-        replay_buffer[idx] = episode
+    replay_buffer.finish_episode(slot, t)
 
 
 def get_trajectories(batch_size=8, timesteps=10, random_start=True):
@@ -73,32 +65,9 @@ def get_trajectories(batch_size=8, timesteps=10, random_start=True):
     simulation_count = max(batch_size - len(replay_buffer), simulation_count)
     simulate_to_replay_buffer(simulation_count)
 
-    # Sample episodes from the replay buffer
-    states_batch, rewards_batch, dones_batch, actions_batch = [], [], [], []
-    for batch_idx in range(batch_size):
-        # Accumulate trajectory clips
-        states, rewards, actions = [], [], []
-        timesteps_remaining = timesteps
-        dones = []
-        while timesteps_remaining > 0:
-            selected_states, selected_rewards, selected_actions = random.choice(replay_buffer)
-            if random_start:
-                start_idx = np.random.randint(0, len(selected_states) - 3)
-            else:
-                start_idx = 0
-            end_idx = min(start_idx + timesteps_remaining, len(selected_states) - 1)
-            duration = end_idx - start_idx
-            states.extend(selected_states[start_idx:end_idx])
-            rewards.extend(selected_rewards[start_idx:end_idx])
-            actions.extend(selected_actions[start_idx:end_idx])
-            dones.extend([False for _ in range(duration - 1)] + [True])
-            timesteps_remaining -= duration
-
-        states_batch.append(np.array(states))  # BHWC
-        rewards_batch.append(np.array(rewards))
-        dones_batch.append(np.array(dones))
-        actions_batch.append(np.array(actions))
-    return np.array(states_batch), np.array(rewards_batch), np.array(dones_batch), np.array(actions_batch)
+    # Sample clips from the replay buffer
+    states, rewards, actions, dones = replay_buffer.sample(batch_size, timesteps, random_start)
+    return states, rewards, dones, actions
 
 
 if __name__ == '__main__':
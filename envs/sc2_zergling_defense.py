@@ -8,6 +8,8 @@ from threading import Thread
 import imutil
 import gym
 
+from replay_buffer import ReplayBuffer
+
 from sc2env.environments.zergling_defense import ZerglingDefenseEnvironment
 
 REPLAY_BUFFER_LEN = 100
@@ -18,7 +20,7 @@ NUM_ACTIONS = 5
 NUM_REWARDS = 4
 NO_OP_ACTION = 4
 
-replay_buffer = []
+replay_buffer = ReplayBuffer(REPLAY_BUFFER_LEN, MAX_TRAJECTORY_LEN)
 initialized = False
 simulation_iters = 0
 env = None
@@ -46,7 +48,7 @@ def play_game_thread():
                 simulation_iters, len(replay_buffer)))
         if simulation_iters > 0 and simulation_iters % MAX_EPISODES_PER_ENVIRONMENT == 0:
             del env
-            init()
+            env = ZerglingDefenseEnvironment()
 
 
 def default_policy(*args, **kwargs):
@@ -67,33 +69,24 @@ def simulate_to_replay_buffer(batch_size):
 
 
 def play_episode(env, policy):
-    states, rgb_states, rewards, actions = [], [], [], []
+    # Each timestep is written straight into the replay buffer's storage
+    slot = replay_buffer.start_episode()
     state = env.reset()
     reward = np.zeros(NUM_REWARDS)
     done = False
+    t = 0
     while True:
         action = policy(state)
         state, rgb_state = convert_frame(state)
-        states.append(state)
-        rgb_states.append(rgb_state)
-        rewards.append(reward)
-        actions.append(action)
-        if len(states) >= MAX_TRAJECTORY_LEN:
+        replay_buffer.write_timestep(slot, t, (state, rgb_state, reward, action))
+        t += 1
+        if t >= MAX_TRAJECTORY_LEN:
             done = True
         if done:
             break
         state, reward_sum, done, info = env.step(action)
         reward = np.array(list(info.values()))
-    trajectory = (np.array(states), np.array(rgb_states), np.array(rewards), np.array(actions))
-    add_to_replay_buffer(trajectory)
-
-
-def add_to_replay_buffer(episode):
-    if len(replay_buffer) < REPLAY_BUFFER_LEN:
-        replay_buffer.append(episode)
-    else:
-        idx = np.random.randint(0, REPLAY_BUFFER_LEN)
-        replay_buffer[idx] = episode
+    replay_buffer.finish_episode(slot, t)
 
 
 def get_trajectories(batch_size=8, timesteps=10, random_start=True):
@@ -104,46 +97,21 @@ def get_trajectories(batch_size=8, timesteps=10, random_start=True):
         print('Error: Simulator thread has died!')
         raise Exception('Simulator thread crashed')
 
-    # Run the game and add new episodes into the replay buffer
-    while len(replay_buffer) < MIN_REPLAY_BUFFER_LEN:
+    # Wake up as soon as the simulator has added enough episodes to the replay buffer
+    while not replay_buffer.wait_for_episodes(MIN_REPLAY_BUFFER_LEN, timeout=1):
         print('Waiting for replay buffer to fill, buffer size {}/{}...'.format(
             len(replay_buffer), MIN_REPLAY_BUFFER_LEN))
-        time.sleep(1)
-
-    # Sample episodes from the replay buffer
-    states_batch, rgb_states_batch, rewards_batch, dones_batch, actions_batch = [], [], [], [], []
-    for batch_idx in range(batch_size):
-        # Accumulate trajectory clips
-        states, rgb_states, rewards, actions = [], [], [], []
-        timesteps_remaining = timesteps
-        dones = []
-        while timesteps_remaining > 0:
-            selected_states, selected_rgb_states, selected_rewards, selected_actions = random.choice(replay_buffer)
-            if random_start:
-                start_idx = np.random.randint(0, len(selected_states) - 3)
-            else:
-                start_idx = 0
-            end_idx = min(start_idx + timesteps_remaining, len(selected_states) - 1)
-            duration = end_idx - start_idx
-            states.extend(selected_states[start_idx:end_idx])
-            rgb_states.extend(selected_rgb_states[start_idx:end_idx])
-            rewards.extend(selected_rewards[start_idx:end_idx])
-            actions.extend(selected_actions[start_idx:end_idx])
-            dones.extend([False for _ in range(duration - 1)] + [True])
-            timesteps_remaining -= duration
-
-        states_batch.append(np.array(states))  # BHWC
-        rgb_states_batch.append(np.array(rgb_states))
-        rewards_batch.append(np.array(rewards))
-        dones_batch.append(np.array(dones))
-        actions_batch.append(np.array(actions))
-    return np.array(states_batch), np.array(rgb_states_batch), np.array(rewards_batch), np.array(dones_batch), np.array(actions_batch)
+
+    # Sample clips from the replay buffer
+    states, rgb_states, rewards, actions, dones = replay_buffer.sample(batch_size, timesteps, random_start)
+    return states, rgb_states, rewards, dones, actions
 
 
 def convert_frame(state, width=64, height=64):
     feature_map, feature_screen, rgb_map, rgb_screen = state
     # Reconstruct the feature map
-    return feature_screen, rgb_screen / 255.
+    # Feature layers are not pixel intensities, so they must not be stored as uint8
+    return np.asarray(feature_screen, dtype=np.float32), np.asarray(rgb_screen, dtype=np.uint8)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+import numpy as np
+
+from envs.betterpong import BetterPongEnv, BetterPongVecEnv, render_state, get_trajectories, NUM_ACTIONS
+
+STATE_VARIABLES = ['left_y', 'right_y', 'ball_x', 'ball_y', 'ball_velocity_x', 'ball_velocity_y']
+
+
+# One scalar env per game of vec_env, starting from the same state
+def scalar_copies(vec_env):
+    envs = []
+    for i in range(vec_env.batch_size):
+        env = BetterPongEnv()
+        for name in STATE_VARIABLES:
+            setattr(env, name, int(getattr(vec_env, name)[i]))
+        envs.append(env)
+    return envs
+
+
+def check_same_state(vec_env, envs, states):
+    for name in STATE_VARIABLES:
+        assert getattr(vec_env, name).tolist() == [getattr(env, name) for env in envs], name
+    for i, env in enumerate(envs):
+        expected = render_state(env.left_y, env.right_y, env.ball_x, env.ball_y,
+                                env.ball_velocity_x, env.ball_velocity_y)
+        assert (states[i] == expected).all()
+
+
+def test_vec_env_matches_scalar_env():
+    np.random.seed(0)
+    batch_size = 64
+    vec_env = BetterPongVecEnv(batch_size)
+    envs = scalar_copies(vec_env)
+    check_same_state(vec_env, envs, vec_env.render())
+
+    scores = set()
+    for t in range(200):
+        actions = np.random.randint(NUM_ACTIONS, size=batch_size)
+        states, rewards, dones, _ = vec_env.step(actions)
+        expected = [env.step(a) for env, a in zip(envs, actions)]
+        assert rewards.tolist() == [reward for _, reward, _, _ in expected]
+        assert dones.tolist() == [done for _, _, done, _ in expected]
+        assert all((state == s).all() for state, (s, _, _, _) in zip(states, expected))
+        check_same_state(vec_env, envs, states)
+        scores.update(rewards.tolist())
+    # The games scored on both sides, so every branch of the physics was exercised
+    assert scores == {-1, 0, 1}
+
+
+def test_get_trajectories_shapes():
+    states, rewards, dones, actions = get_trajectories(batch_size=4, timesteps=5)
+    assert states.shape == (4, 5, 3, 64, 64) and states.dtype == bool
+    assert rewards.shape == (4, 5, 1)
+    assert dones.shape == (4, 5)
+    assert actions.shape == (4, 5)
@@ -10,7 +10,7 @@ def visualize_bptt(z, transition, reward_predictor, decoder, rgb_decoder, num_ac
     if vid is None:
         vid = imutil.Video(filename='excitation_bptt_{}.mp4'.format(int(time.time())), framerate=10)
     for t in range(30):
-        a = onehot(1) if t == 0 else onehot(3)
+        a = onehot(1, device=z.device) if t == 0 else onehot(3, device=z.device)
         a.requires_grad = True
         a.retain_grad()
 
@@ -32,7 +32,7 @@ def visualize_bptt(z, transition, reward_predictor, decoder, rgb_decoder, num_ac
             print('Expected reward of {:.2f} at time t+{}'.format(r.sum(), t))
             for _ in range(20):
                 vid.write_frame(rgb_decoder(decoder(z))[0], resize_to=(512, 512), caption=caption)
-            localized_expected_reward = (rmap * (rmap.abs() == rmap.abs().max()).type(torch.cuda.FloatTensor)).sum()
+            localized_expected_reward = (rmap * (rmap.abs() == rmap.abs().max()).float()).sum()
             localized_expected_reward.backward(retain_graph=True)
             print([at*at.grad for at in actions])
             '''
@@ -53,9 +53,9 @@ def visualize_bptt(z, transition, reward_predictor, decoder, rgb_decoder, num_ac
     return True
 
 
-def onehot(a_idx, num_actions=4):
+def onehot(a_idx, num_actions=4, device='cuda'):
     if type(a_idx) is int:
         # Usage: onehot(2)
-        return torch.eye(num_actions)[a_idx].unsqueeze(0).cuda()
+        return torch.eye(num_actions, device=device)[a_idx].unsqueeze(0)
     # Usage: onehot([1,2,3])
-    return torch.eye(num_actions)[a_idx].cuda()
+    return torch.eye(num_actions, device=device)[a_idx]
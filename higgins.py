@@ -2,12 +2,13 @@ import numpy as np
 import torch
 from torch import nn
 from logutil import TimeSeries
+from utils import frames_to_tensor
 
 class LinearClassifier(nn.Module):
-    def __init__(self, input_dim, output_classes):
+    def __init__(self, input_dim, output_classes, device='cuda'):
         super().__init__()
         self.fc1 = torch.nn.Linear(input_dim, output_classes)
-        self.cuda()
+        self.to(device)
 
     def forward(self, x):
         x = self.fc1(x)
@@ -24,7 +25,8 @@ def higgins_metric(simulator, true_latent_dim, encoder, encoded_latent_dim,
     # Train a linear classifier using uniform randomly-generated pairs of images,
     # where the pair shares one generative factor in common.
     # Given the learned encodings of a pair, predict which factor is the same.
-    linear_model = LinearClassifier(encoded_latent_dim, true_latent_dim)
+    device = next(encoder.parameters()).device
+    linear_model = LinearClassifier(encoded_latent_dim, true_latent_dim, device=device)
     optimizer = torch.optim.Adam(linear_model.parameters())
     ts = TimeSeries('Computing Higgins Metric', train_iters)
 
@@ -43,10 +45,10 @@ def higgins_metric(simulator, true_latent_dim, encoder, encoded_latent_dim,
             images_right = simulator(random_factors[:,1,:])
 
             # Now encode each pair and take their difference
-            x_left = torch.FloatTensor(images_left).cuda()
+            x_left = frames_to_tensor(images_left, device)
             if len(x_left.shape) < 4:
                 x_left = x_left.unsqueeze(1)
-            x_right = torch.FloatTensor(images_right).cuda()
+            x_right = frames_to_tensor(images_right, device)
             if len(x_right.shape) < 4:
                 x_right = x_right.unsqueeze(1)
             encoded_left = encoder(x_left)[0].data.cpu().numpy()
@@ -61,11 +63,11 @@ def higgins_metric(simulator, true_latent_dim, encoder, encoded_latent_dim,
         for l in range(L):
             z_diffs[l] = generate_equivariance_test_batch(y_labels)
         z_diff = np.mean(z_diffs, axis=0)
-        z_diff = torch.FloatTensor(z_diff).cuda()
+        z_diff = torch.tensor(z_diff, dtype=torch.float, device=device)
 
         # Now given z_diff, predict y_labels
         optimizer.zero_grad()
-        target = torch.LongTensor(y_labels).cuda()
+        target = torch.tensor(y_labels, dtype=torch.long, device=device)
         logits = linear_model(z_diff)
         y_pred = torch.softmax(logits, dim=1).max(1, keepdim=True)[1]
         num_correct = y_pred.eq(target.view_as(y_pred)).sum().item()
@@ -92,7 +94,8 @@ def higgins_metric_conv(simulator, true_latent_dim, encoder, encoded_latent_dim,
     # Train a linear classifier using uniform randomly-generated pairs of images,
     # where the pair shares one generative factor in common.
     # Given the learned encodings of a pair, predict which factor is the same.
-    linear_model = LinearClassifier(encoded_latent_dim, true_latent_dim)
+    device = next(encoder.parameters()).device
+    linear_model = LinearClassifier(encoded_latent_dim, true_latent_dim, device=device)
     optimizer = torch.optim.Adam(linear_model.parameters())
     ts = TimeSeries('Computing Higgins Metric', train_iters)
 
@@ -111,10 +114,10 @@ def higgins_metric_conv(simulator, true_latent_dim, encoder, encoded_latent_dim,
             images_right = simulator(random_factors[:,1,:])
 
             # Now encode each pair and take their difference
-            x_left = torch.FloatTensor(images_left).cuda()
+            x_left = frames_to_tensor(images_left, device)
             if len(x_left.shape) < 4:
                 x_left = x_left.unsqueeze(1)
-            x_right = torch.FloatTensor(images_right).cuda()
+            x_right = frames_to_tensor(images_right, device)
             if len(x_right.shape) < 4:
                 x_right = x_right.unsqueeze(1)
             encoded_left = encoder(x_left)[0]
@@ -129,11 +132,11 @@ def higgins_metric_conv(simulator, true_latent_dim, encoder, encoded_latent_dim,
         for l in range(L):
             z_diffs[l] = generate_equivariance_test_batch(y_labels)
         z_diff = np.mean(z_diffs, axis=0)
-        z_diff = torch.FloatTensor(z_diff).cuda()
+        z_diff = torch.tensor(z_diff, dtype=torch.float, device=device)
 
         # Now given z_diff, predict y_labels
         optimizer.zero_grad()
-        target = torch.LongTensor(y_labels).cuda()
+        target = torch.tensor(y_labels, dtype=torch.long, device=device)
         logits = linear_model(z_diff)
         y_pred = torch.softmax(logits, dim=1).max(1, keepdim=True)[1]
         num_correct = y_pred.eq(target.view_as(y_pred)).sum().item()
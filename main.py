@@ -10,6 +10,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
 import pandas as pd
 
 import imutil
@@ -19,7 +20,10 @@ import models
 from datasource import allocate_datasource
 from causal_graph import render_causal_graph
 from higgins import higgins_metric_conv
-from utils import cov
+from utils import cov, frames_to_tensor
+from prefetch import BatchPrefetcher
+from planner import RecedingHorizonPlanner, TranspositionTable, simulate_step, admissible_prune_bound
+from spectral_normalization import freeze_spectral_norm, precompute_spectral_norm
 
 
 parser = argparse.ArgumentParser(description="Learn to model a sequential environment")
@@ -27,18 +31,37 @@ parser.add_argument('--env', required=True, help='One of: boxes, minipong, Pong-
 parser.add_argument('--load-from', type=str, help='Directory containing .pth models to load before starting')
 parser.add_argument('--evaluate', action='store_true', help='If true, evaluate instead of training')
 parser.add_argument('--evaluations', type=int, default=1, help='Integer number of evaluations to run')
+parser.add_argument('--rollout-depth', type=int, default=12, help='Planner rollout depth, or the max depth with --decision-budget-ms')
+parser.add_argument('--lookahead', type=int, default=2, help='Number of planner steps after the first action that branch on every action')
+parser.add_argument('--prune-bound', type=float, help='Branch-and-bound: drop planner branches trailing the best by more than this much value per remaining step. A hand-set bound below --admissible-pruning\'s may change the chosen action (default: no pruning)')
+parser.add_argument('--admissible-pruning', action='store_true', help='Branch-and-bound with the bound derived from the reward head\'s output range, which never changes the chosen action')
+parser.add_argument('--decision-budget-ms', type=float, help='Deepen planner rollouts until this many milliseconds have passed, then act on the best action found (default: fixed depth)')
+parser.add_argument('--replan-threshold', type=float, help='Keep the planner beam between steps unless the re-encoded latent differs from its prediction by more than this mean absolute difference (default: replan every step)')
+parser.add_argument('--transposition-table-size', type=int, default=0, help='Memoize planner expansions from identical binary latent states in an LRU table of this many beams, kept on the device (0 to disable)')
 parser.add_argument('--title', type=str, help='Name of experiment in output figures')
 parser.add_argument('--batch-size', type=int, default=32, help='Training batch size')
 parser.add_argument('--train-iters', type=int, default=10000, help='Number of iterations of training')
 parser.add_argument('--start-iter', type=int, default=1, help='Start iteration when resuming from checkpoint')
-
-parser.add_argument('--truncate-bptt', action='store_true', help='Train only with timestep-local information (training only)')
+parser.add_argument('--sim-workers', type=int, default=0, help='Number of simulator processes for replay-based envs (0 simulates in a thread)')
+parser.add_argument('--samples-per-insert', type=float, default=0, help='Target ratio of sampled clips to simulated episodes for replay-based envs (0 for no limit)')
+parser.add_argument('--prefetch-batches', type=int, default=0, help='Number of training batches to prepare ahead in background threads (0 to disable). The datasource must allow get_trajectories to be called from several threads at once, as evaluation keeps calling it from the main thread')
+parser.add_argument('--prefetch-workers', type=int, default=1, help='Number of background threads preparing training batches')
+parser.add_argument('--device', type=str, default='cuda', help='Torch device for models and tensors, eg. cuda, cuda:1 or cpu')
+parser.add_argument('--num-threads', type=int, help='Number of intra-op threads for CPU execution (default: torch default)')
+parser.add_argument('--num-interop-threads', type=int, help='Number of inter-op threads for CPU execution (default: torch default)')
+parser.add_argument('--bf16', action='store_true', help='Run the networks under bfloat16 autocast for training, planning and evaluation')
+parser.add_argument('--replay-ring-dir', type=str, help='Directory for memory-mapped replay rings of replay-based envs: a fixed number of episode slots, reopened by later runs, where new episodes overwrite the oldest')
+
+parser.add_argument('--truncate-bptt', action='store_true', help='Train only with timestep-local information, same as --bptt-window 1 (training only)')
+parser.add_argument('--bptt-window', type=int, default=0, help='Backpropagate through windows of k transitions, detaching between windows (0 for full BPTT) (training only)')
+parser.add_argument('--bptt-overlap', type=int, default=0, help='With --bptt-window, re-simulate this many steps before each window so gradients cross its start (training only)')
 parser.add_argument('--latent-overshooting', action='store_true', help='Train with Latent Overshooting from Hafner et al. (training only)')
 parser.add_argument('--latent-td', action='store_true', help='Train with the Temporal Difference objective (training only)')
 parser.add_argument('--td-lambda', type=float, default=0.9, help='Scalar lambda hyperparameter for TD or overshooting (training only)')
 parser.add_argument('--td-steps', type=int, default=3, help='Number of concurrent TD forward predictions (training only)')
 parser.add_argument('--horizon-min', type=int, default=3, help='Min timestep horizon value (training only)')
 parser.add_argument('--horizon-max', type=int, default=10, help='Max timestep horizon value (training only)')
+parser.add_argument('--checkpoint-every', type=int, default=0, help='Checkpoint the transition rollout every k steps, recomputing it on backward to save memory (0 to disable) (training only)')
 parser.add_argument('--learning-rate', type=float, default=.0001, help='Adam lr value (training only)')
 parser.add_argument('--finetune-reward', action='store_true', help='Train ONLY the reward estimation network (training only)')
 parser.add_argument('--reward-coef', type=float, default=.001, help='Reward loss magnitude (training only)')
@@ -60,21 +83,34 @@ enable_control_bias_loss = args.enable_action_control_loss
 torch.backends.cudnn.benchmark = True
 torch.backends.cudnn.enabled = True
 
+device = torch.device(args.device)
+if args.num_threads:
+    torch.set_num_threads(args.num_threads)
+if args.num_interop_threads:
+    torch.set_num_interop_threads(args.num_interop_threads)
+
 
 def main():
     latent_dim = 16
 
-    datasource = allocate_datasource(args.env)
+    datasource = allocate_datasource(args.env, sim_workers=args.sim_workers,
+                                     samples_per_insert=args.samples_per_insert,
+                                     replay_ring_dir=args.replay_ring_dir)
     num_actions = datasource.binary_input_channels
     num_rewards = datasource.scalar_output_channels
     input_channels = datasource.conv_input_channels
     output_channels = datasource.conv_output_channels
 
-    encoder = (models.Encoder(latent_dim, input_channels))
-    decoder = (models.Decoder(latent_dim, output_channels))
-    reward_predictor = (models.RewardPredictor(latent_dim, num_rewards))
-    discriminator = (models.Discriminator())
-    transition = (models.Transition(latent_dim, num_actions))
+    encoder = (models.Encoder(latent_dim, input_channels, device=device))
+    decoder = (models.Decoder(latent_dim, output_channels, device=device))
+    reward_predictor = (models.RewardPredictor(latent_dim, num_rewards, device=device))
+    discriminator = (models.Discriminator(device=device))
+    transition = (models.Transition(latent_dim, num_actions, device=device))
+
+    # On CPU, convolutions run fastest with NHWC (channels-last) weights and activations
+    if device.type == 'cpu':
+        for model in (encoder, decoder, reward_predictor, discriminator, transition):
+            model.to(memory_format=torch.channels_last)
 
     if args.load_from is None:
         print('No --load-from directory specified: initializing new networks')
@@ -83,16 +119,19 @@ def main():
         raise ValueError('Failed to load weights from *.pth')
     else:
         print('Loading models from directory {}'.format(args.load_from))
-        encoder.load_state_dict(torch.load(os.path.join(args.load_from, 'model-encoder.pth')))
-        decoder.load_state_dict(torch.load(os.path.join(args.load_from, 'model-decoder.pth')))
-        transition.load_state_dict(torch.load(os.path.join(args.load_from, 'model-transition.pth')))
-        discriminator.load_state_dict(torch.load(os.path.join(args.load_from, 'model-discriminator.pth')))
-        reward_predictor.load_state_dict(torch.load(os.path.join(args.load_from, 'model-reward_predictor.pth')))
+        encoder.load_state_dict(torch.load(os.path.join(args.load_from, 'model-encoder.pth'), map_location=device))
+        decoder.load_state_dict(torch.load(os.path.join(args.load_from, 'model-decoder.pth'), map_location=device))
+        transition.load_state_dict(torch.load(os.path.join(args.load_from, 'model-transition.pth'), map_location=device))
+        discriminator.load_state_dict(torch.load(os.path.join(args.load_from, 'model-discriminator.pth'), map_location=device))
+        reward_predictor.load_state_dict(torch.load(os.path.join(args.load_from, 'model-reward_predictor.pth'), map_location=device))
 
     if args.evaluate:
+        # Weights are fixed from here on: bake spectral normalization into plain convs
+        for model in (encoder, decoder, reward_predictor, discriminator, transition):
+            freeze_spectral_norm(model)
         print('Finished {} playthroughs'.format(args.evaluations))
         for _ in range(args.evaluations):
-            with torch.no_grad():
+            with torch.no_grad(), reduced_precision():
                 play(latent_dim, datasource, num_actions, num_rewards, encoder, decoder,
                      reward_predictor, discriminator, transition)
         print('Finished {} playthroughs'.format(args.evaluations))
@@ -109,7 +148,8 @@ def train(latent_dim, datasource, num_actions, num_rewards,
     train_iters = args.train_iters
     td_lambda_coef = args.td_lambda
     td_steps = args.td_steps
-    truncate_bptt = args.truncate_bptt
+    bptt_window = 1 if args.truncate_bptt else args.bptt_window
+    bptt_overlap = args.bptt_overlap if bptt_window else 0
     enable_td = args.latent_td
     enable_latent_overshooting = args.latent_overshooting
     learning_rate = args.learning_rate
@@ -121,6 +161,7 @@ def train(latent_dim, datasource, num_actions, num_rewards,
     TRANSITION_L1_COEF = args.transition_l1_coef
     counterfactual_horizon = args.counterfactual_horizon
     start_iter = args.start_iter
+    checkpoint_every = args.checkpoint_every
 
     opt_enc = torch.optim.Adam(encoder.parameters(), lr=learning_rate)
     opt_dec = torch.optim.Adam(decoder.parameters(), lr=learning_rate)
@@ -129,6 +170,17 @@ def train(latent_dim, datasource, num_actions, num_rewards,
     opt_pred = torch.optim.Adam(reward_predictor.parameters(), lr=learning_rate)
     ts = TimeSeries('Training Model', train_iters, tensorboard=True)
 
+    # The prediction horizon grows from min to max over the course of training
+    def get_prediction_horizon(train_iter):
+        theta = train_iter / train_iters
+        pred_delta = max_prediction_horizon - min_prediction_horizon
+        return min_prediction_horizon + int(pred_delta * theta)
+
+    # Batches for upcoming iterations are built while the current one trains
+    prefetcher = BatchPrefetcher(datasource, batch_size, get_prediction_horizon, start_iter, train_iters,
+                                 num_batches=args.prefetch_batches, num_workers=args.prefetch_workers,
+                                 device=device)
+
     for train_iter in range(start_iter, train_iters + 1):
         if train_iter % ITERS_PER_VIDEO == 0:
             print('Evaluating networks...')
@@ -141,8 +193,7 @@ def train(latent_dim, datasource, num_actions, num_rewards,
             torch.save(reward_predictor.state_dict(), 'model-reward_predictor.pth')
 
         theta = train_iter / train_iters
-        pred_delta = max_prediction_horizon - min_prediction_horizon
-        prediction_horizon = min_prediction_horizon + int(pred_delta * theta)
+        prediction_horizon = get_prediction_horizon(train_iter)
 
         train_mode([encoder, decoder, transition, discriminator, reward_predictor])
 
@@ -152,135 +203,149 @@ def train(latent_dim, datasource, num_actions, num_rewards,
         opt_trans.zero_grad()
         opt_pred.zero_grad()
 
-        states, rewards, dones, actions = datasource.get_trajectories(batch_size, prediction_horizon)
-        states = torch.Tensor(states).cuda()
-        rewards = torch.Tensor(rewards).cuda()
-        dones = torch.Tensor(dones.astype(int)).cuda()
-
-        # Encode the initial state (using the first 3 frames)
-        # Given t, t+1, t+2, encoder outputs the state at time t+1
-        z = encoder(states[:, 0:3])
-        z_orig = z.clone()
-
-        # But wait, here's the problem: We can't use the encoded initial state as
-        # an initial state of the dynamical system and expect the system to work
-        # The dynamical system needs to have something like the Echo State Property
-        # So the dynamical parts need to run long enough to reach a steady state
-
-        # Keep track of "done" states to stop a training trajectory at the final time step
-        active_mask = torch.ones(batch_size).cuda()
-
-        loss = 0
-        lo_loss = 0
-        lo_z_set = {}
-        # Given the state encoded at t=2, predict state at t=3, t=4, ...
-        for t in range(1, prediction_horizon - 1):
-            active_mask = active_mask * (1 - dones[:, t])
+        states, rewards, dones, actions = prefetcher.get(train_iter)
+
+        # Forward passes run under bfloat16 autocast with --bf16; backward runs outside it
+        with reduced_precision():
+            # Encode the initial state (using the first 3 frames)
+            # Given t, t+1, t+2, encoder outputs the state at time t+1
+            z = encoder(states[:, 0:3])
+            z_orig = z.clone()
+
+            # But wait, here's the problem: We can't use the encoded initial state as
+            # an initial state of the dynamical system and expect the system to work
+            # The dynamical system needs to have something like the Echo State Property
+            # So the dynamical parts need to run long enough to reach a steady state
+
+            # Keep track of "done" states to stop a training trajectory at the final time step
+            # active_masks[:, i] is the mask for time step t = i + 1
+            active_masks = torch.cumprod(1 - dones[:, 1:prediction_horizon - 1], dim=1)
+            active_mask = active_masks[:, -1]
+
+            loss = 0
+            # The latent trajectory is rolled out first; decoder and reward heads run on all of it at once
+            # Given the state encoded at t=2, predict state at t=3, t=4, ...
+            # With windowed BPTT, gradients stop at the start of each window of bptt_window
+            # transitions; with an overlap, each window begins by re-simulating the
+            # bptt_overlap steps before it from a detached state, replaying the samples
+            # drawn on the main trajectory so that the window starts from the same state
+            z_history = {1: z.detach()}
+            def rollout_steps(z, t_start, t_end):
+                z_steps = []
+                for t in range(t_start, t_end):
+                    if bptt_window and t > 1 and (t - 1) % bptt_window == 0:
+                        if bptt_overlap:
+                            burn_in_start = max(1, t - bptt_overlap)
+                            z = z_history[burn_in_start]
+                            for t_i in range(burn_in_start, t):
+                                z = transition(z, actions[:, t_i], sample=z_history[t_i + 1])
+                        else:
+                            z = z.detach()
+
+                    # Apply activation L1 loss
+                    #l1_values = z.abs().mean(-1).mean(-1).mean(-1)
+                    #l1_loss = ACTIVATION_L1_COEF * torch.mean(l1_values * active_mask)
+                    #ts.collect('L1 t={}'.format(t), l1_loss)
+                    #loss += theta * l1_loss
+
+                    # Predict transition to the next state
+                    new_z = transition(z, actions[:, t])
+
+                    # Apply transition L1 loss
+                    #t_l1_values = ((new_z - z).abs().mean(-1).mean(-1).mean(-1))
+                    #t_l1_loss = TRANSITION_L1_COEF * torch.mean(t_l1_values * active_mask)
+                    #ts.collect('T-L1 t={}'.format(t), t_l1_loss)
+                    #loss += theta * t_l1_loss
+
+                    z = new_z
+                    if bptt_overlap:
+                        z_history[t + 1] = z.detach()
+                    z_steps.append(z)
+                return tuple(z_steps)
+
+            # With checkpointing, each segment of k transitions keeps only its output
+            # latents; its activations are recomputed (with the same random draws) on backward
+            rollout_end = prediction_horizon - 1
+            segment_length = checkpoint_every or rollout_end
+            if checkpoint_every:
+                # Segments must find the normalized weights cached, both now and when recomputed
+                precompute_spectral_norm(transition)
+            z_seq = [z]
+            for t_start in range(1, rollout_end, segment_length):
+                t_end = min(t_start + segment_length, rollout_end)
+                if checkpoint_every:
+                    z_seq.extend(checkpoint(rollout_steps, z_seq[-1], t_start, t_end, use_reentrant=False))
+                else:
+                    z_seq.extend(rollout_steps(z_seq[-1], t_start, t_end))
+            # The final state is not scored by the heads; the CF losses start from it
+            z = z_seq.pop()
+
+            # Run the heads once over the stacked (T * batch_size) trajectory
+            timesteps = len(z_seq)
+            z_flat = torch.cat(z_seq)
 
             # Predict reward
-            expected_reward = reward_predictor(z)
-            actual_reward = rewards[:, t]
-            reward_difference = torch.mean(torch.mean((expected_reward - actual_reward)**2, dim=1) * active_mask)
-            ts.collect('Rd Loss t={}'.format(t), reward_difference)
-            loss += theta * REWARD_COEF * reward_difference  # Normalize by height * width
+            expected_reward = reward_predictor(z_flat).reshape(timesteps, batch_size, -1).transpose(0, 1)
+            actual_reward = rewards[:, 1:timesteps + 1]
+            reward_difference = (torch.mean((expected_reward - actual_reward)**2, dim=2) * active_masks).mean(0)
+            loss += theta * REWARD_COEF * reward_difference.sum()  # Normalize by height * width
 
             # Reconstruction loss
-            target_pixels = states[:, t]
-            predicted = torch.sigmoid(decoder(z))
-            rec_loss_batch = decoder_pixel_loss(target_pixels, predicted)
-
-            if truncate_bptt and t > 1:
-                z.detach_()
-
-            rec_loss = torch.mean(rec_loss_batch * active_mask)
-            ts.collect('Reconstruction t={}'.format(t), rec_loss)
-            loss += rec_loss
-
-            # Apply activation L1 loss
-            #l1_values = z.abs().mean(-1).mean(-1).mean(-1)
-            #l1_loss = ACTIVATION_L1_COEF * torch.mean(l1_values * active_mask)
-            #ts.collect('L1 t={}'.format(t), l1_loss)
-            #loss += theta * l1_loss
+            target_pixels = states[:, 1:timesteps + 1]
+            predicted_logits = decoder(z_flat)
+            predicted_logits = predicted_logits.reshape((timesteps, batch_size) + predicted_logits.shape[1:]).transpose(0, 1)
+            rec_loss_batch = decoder_pixel_loss(target_pixels, predicted_logits)
+            rec_loss = (rec_loss_batch * active_masks).mean(0)
+            loss += rec_loss.sum()
 
-            # Predict transition to the next state
-            onehot_a = torch.eye(num_actions)[actions[:, t]].cuda()
-            new_z = transition(z, onehot_a)
-
-            # Apply transition L1 loss
-            #t_l1_values = ((new_z - z).abs().mean(-1).mean(-1).mean(-1))
-            #t_l1_loss = TRANSITION_L1_COEF * torch.mean(t_l1_values * active_mask)
-            #ts.collect('T-L1 t={}'.format(t), t_l1_loss)
-            #loss += theta * t_l1_loss
-
-            z = new_z
+            for i, t in enumerate(range(1, timesteps + 1)):
+                ts.collect('Rd Loss t={}'.format(t), reward_difference[i])
+                ts.collect('Reconstruction t={}'.format(t), rec_loss[i])
 
             if enable_latent_overshooting:
                 # Latent Overshooting, Hafner et al.
-                lo_z_set[t] = encoder(states[:, t-1:t+2])
-
-                # For each previous t_left, step forward to t
-                for t_left in range(1, t):
-                    a = torch.eye(num_actions)[actions[:, t - 1]].cuda()
-                    lo_z_set[t_left] = transition(lo_z_set[t_left], a)
-                for t_a in range(2, t - 1):
-                    # It's like TD but only N:1 for all N
-                    predicted_activations = lo_z_set[t_a]
-                    target_activations = lo_z_set[t].detach()
-                    lo_loss_batch = latent_state_loss(target_activations, predicted_activations)
-                    lo_loss += td_lambda_coef * torch.mean(lo_loss_batch * active_mask)
-
-        if enable_latent_overshooting:
-            ts.collect('LO total', lo_loss)
-            loss += theta * lo_loss
-
-        # COUNTERFACTUAL DISENTANGLEMENT REGULARIZATION
-        # Suppose that our representation is ideally, perfectly disentangled
-        # Then the PGM has no edges, the causal graph is just nodes with no relationships
-        # In this case, it should be true that intervening on any one factor has no effect on the others
-        # One fun way of intervening is swapping factors, a la FactorVAE
-        # If we intervene on some dimensions, the other dimensions should be unaffected
-        if enable_cf_shuffle_loss and train_iter % CF_REGULARIZATION_RATE == 0:
-            # Counterfactual scenario A: our memory of what really happened
-            z_cf_a = z.clone()
-            # Counterfactual scenario B: a bizzaro world where two dimensions are swapped
-            z_cf_b = z_orig
-            unswapped_factor_map = torch.ones((batch_size, latent_dim)).cuda()
-            for i in range(batch_size):
-                idx_a = np.random.randint(latent_dim)
-                idx_b = np.random.randint(latent_dim)
-                unswapped_factor_map[i, idx_a] = 0
-                unswapped_factor_map[i, idx_b] = 0
-                z_cf_b[i, idx_a], z_cf_b[i, idx_b] = z_cf_b[i, idx_b], z_cf_b[i, idx_a]
-            # But we take the same actions
-            for t in range(1, counterfactual_horizon):
-                onehot_a = torch.eye(num_actions)[actions[:, t]].cuda()
-                z_cf_b = transition(z_cf_b, onehot_a)
-            # Every UNSWAPPED dimension should be as similar as possible to its bizzaro-world equivalent
-            cf_loss = torch.abs(z_cf_a - z_cf_b).mean(-1).mean(-1) * unswapped_factor_map
-            cf_loss = CF_REGULARIZATION_LAMBDA * torch.mean(cf_loss.mean(-1) * active_mask)
-            loss += cf_loss
-            ts.collect('CF Disentanglement Loss', cf_loss)
-
-        # COUNTERFACTUAL ACTION-CONTROL REGULARIZATION
-        # In difficult POMDPs, deep neural networks can suffer from learned helplessness
-        # They learn, rationally, that their actions have no causal influence on the reward
-        # This is undesirable: the learned model should assume that outcomes are controllable
-        if enable_control_bias_loss and train_iter % CF_REGULARIZATION_RATE == 0:
-            # Counterfactual scenario A: our memory of what really happened
-            z_cf_a = z.clone()
-            # Counterfactual scenario B: our imagination of what might have happened
-            z_cf_b = z_orig
-            # Instead of the regular actions, apply an alternate policy
-            cf_actions = actions.copy()
-            np.random.shuffle(cf_actions)
-            for t in range(1, counterfactual_horizon):
-                onehot_a = torch.eye(num_actions)[cf_actions[:,t]].cuda()
-                z_cf_b = transition(z_cf_b, onehot_a)
-            eps = .001  # for numerical stability
-            cf_loss = -torch.log(torch.abs(z_cf_a - z_cf_b).mean(-1).mean(-1).mean(-1) + eps)
-            cf_loss = CF_REGULARIZATION_LAMBDA * torch.mean(cf_loss * active_mask)
-            loss += cf_loss
-            ts.collect('CF Control Bias Loss', cf_loss)
+                lo_loss = td_lambda_coef * latent_overshooting_loss(encoder, transition, states, actions, active_masks)
+                ts.collect('LO total', lo_loss)
+                loss += theta * lo_loss
+
+            # COUNTERFACTUAL DISENTANGLEMENT REGULARIZATION
+            # Suppose that our representation is ideally, perfectly disentangled
+            # Then the PGM has no edges, the causal graph is just nodes with no relationships
+            # In this case, it should be true that intervening on any one factor has no effect on the others
+            # One fun way of intervening is swapping factors, a la FactorVAE
+            # If we intervene on some dimensions, the other dimensions should be unaffected
+            if enable_cf_shuffle_loss and train_iter % CF_REGULARIZATION_RATE == 0:
+                # Counterfactual scenario A: our memory of what really happened
+                z_cf_a = z.clone()
+                # Counterfactual scenario B: a bizzaro world where two dimensions are swapped
+                z_cf_b, unswapped_factor_map = random_factor_swap(z_orig)
+                # But we take the same actions
+                for t in range(1, counterfactual_horizon):
+                    z_cf_b = transition(z_cf_b, actions[:, t])
+                # Every UNSWAPPED dimension should be as similar as possible to its bizzaro-world equivalent
+                cf_loss = torch.abs(z_cf_a.float() - z_cf_b.float()).mean(-1).mean(-1) * unswapped_factor_map
+                cf_loss = CF_REGULARIZATION_LAMBDA * torch.mean(cf_loss.mean(-1) * active_mask)
+                loss += cf_loss
+                ts.collect('CF Disentanglement Loss', cf_loss)
+
+            # COUNTERFACTUAL ACTION-CONTROL REGULARIZATION
+            # In difficult POMDPs, deep neural networks can suffer from learned helplessness
+            # They learn, rationally, that their actions have no causal influence on the reward
+            # This is undesirable: the learned model should assume that outcomes are controllable
+            if enable_control_bias_loss and train_iter % CF_REGULARIZATION_RATE == 0:
+                # Counterfactual scenario A: our memory of what really happened
+                z_cf_a = z.clone()
+                # Counterfactual scenario B: our imagination of what might have happened
+                z_cf_b = z_orig
+                # Instead of the regular actions, apply an alternate policy
+                cf_actions = actions[torch.randperm(batch_size, device=device)]
+                for t in range(1, counterfactual_horizon):
+                    z_cf_b = transition(z_cf_b, cf_actions[:, t])
+                eps = .001  # for numerical stability
+                cf_loss = -torch.log(torch.abs(z_cf_a.float() - z_cf_b.float()).mean(-1).mean(-1).mean(-1) + eps)
+                cf_loss = CF_REGULARIZATION_LAMBDA * torch.mean(cf_loss * active_mask)
+                loss += cf_loss
+                ts.collect('CF Control Bias Loss', cf_loss)
 
         loss.backward()
 
@@ -304,11 +369,64 @@ def td_latent_state_loss(target, predicted):
 
 
 def latent_state_loss(target, predicted):
-    return ((target - predicted)**2).mean(-1).mean(-1).mean(-1)
-
-
-def decoder_pixel_loss(target, predicted):
-    rec_loss_batch = F.binary_cross_entropy(predicted, target, reduction='none')
+    return ((target.float() - predicted.float())**2).mean(-1).mean(-1).mean(-1)
+
+
+# Intervene on latent factors: output factor k of example i is input factor
+# factor_index[i, k]. Any (batch_size, latent_dim) index map works, eg. a
+# per-example permutation of the factors, or copying one factor over another
+def intervene_latent_factors(z, factor_index):
+    factor_index = factor_index.reshape(factor_index.shape + (1,) * (z.dim() - 2))
+    return torch.gather(z, 1, factor_index.expand_as(z))
+
+
+# Swap two randomly-chosen factors in each example, a la FactorVAE
+# Returns the swapped latents and a (batch_size, latent_dim) mask of the factors left in place
+def random_factor_swap(z):
+    batch_size, latent_dim = z.shape[:2]
+    swap_idx = torch.randint(latent_dim, (batch_size, 2), device=z.device)
+    factor_index = torch.arange(latent_dim, device=z.device).repeat(batch_size, 1)
+    factor_index.scatter_(1, swap_idx, swap_idx.flip(1))
+    unswapped_factor_map = torch.ones((batch_size, latent_dim), device=z.device)
+    unswapped_factor_map.scatter_(1, swap_idx, 0)
+    return intervene_latent_factors(z, factor_index), unswapped_factor_map
+
+
+# Latent Overshooting: the state encoded at each t is rolled forward by the
+# transition and compared to the states encoded at every later t
+# It's like TD but only N:1 for all N
+# All sliding-window encodings come from one encoder pass, and every overshoot
+# chain in flight advances together as one stacked batch per time step
+def latent_overshooting_loss(encoder, transition, states, actions, active_masks):
+    batch_size, timesteps = active_masks.shape
+    if timesteps < 4:
+        return 0
+
+    # The encoding at t uses frames t-1, t, t+1; chains start at t=2, targets begin at t=4
+    windows = states[:, 1:timesteps + 2].unfold(1, 3, 1)
+    windows = windows.permute(1, 0, 5, 2, 3, 4).reshape((-1, 3) + states.shape[2:])
+    encoded = encoder(windows)
+    encoded = encoded.reshape((timesteps - 1, batch_size) + encoded.shape[1:])
+
+    lo_loss = 0
+    chains = encoded[0]
+    for t in range(3, timesteps + 1):
+        # Chains started at t_left = 2 .. t-1 all step forward to t, in stacked order
+        num_chains = t - 2
+        chains = transition(chains, actions[:, t - 1].repeat(num_chains))
+        if t >= 4:
+            # Chains started at t_left = 2 .. t-2 are compared to the state encoded at t
+            target = encoded[t - 2].detach().repeat(num_chains - 1, 1, 1, 1)
+            lo_loss_batch = latent_state_loss(target, chains[:(num_chains - 1) * batch_size])
+            lo_loss = lo_loss + (lo_loss_batch.reshape(num_chains - 1, batch_size) * active_masks[:, t - 1]).mean(1).sum()
+        if t < timesteps:
+            chains = torch.cat([chains, encoded[t - 2]])
+    return lo_loss
+
+
+# Takes decoder logits: the sigmoid is fused into the loss for numerical stability
+def decoder_pixel_loss(target, logits):
+    rec_loss_batch = F.binary_cross_entropy_with_logits(logits.float(), target, reduction='none')
     return rec_loss_batch.mean(-1).mean(-1).mean(-1)
 
 
@@ -317,9 +435,50 @@ def evaluate(datasource, encoder, decoder, transition, discriminator, reward_pre
     test_mode([encoder, decoder, transition, discriminator, reward_predictor])
 
     timestamp = str(int(time.time()))
-    measure_prediction_mse(datasource, encoder, decoder, transition, reward_predictor, train_iter, num_factors=latent_dim, use_training_set=use_training_set)
-    visualize_forward_simulation(datasource, encoder, decoder, transition, reward_predictor, train_iter, num_factors=latent_dim)
-    visualize_reconstruction(datasource, encoder, decoder, transition, reward_predictor, train_iter=train_iter)
+    if args.bf16:
+        measure_bf16_parity(datasource, encoder, decoder, transition, reward_predictor, train_iter, use_training_set=use_training_set)
+    with reduced_precision():
+        measure_prediction_mse(datasource, encoder, decoder, transition, reward_predictor, train_iter, num_factors=latent_dim, use_training_set=use_training_set)
+        visualize_forward_simulation(datasource, encoder, decoder, transition, reward_predictor, train_iter, num_factors=latent_dim)
+        visualize_reconstruction(datasource, encoder, decoder, transition, reward_predictor, train_iter=train_iter)
+
+
+# With --bf16, model forwards run under bfloat16 autocast
+# Losses and reward sums cast their inputs back to float32
+def reduced_precision(enabled=True):
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16 and enabled)
+
+
+# Compare the pixel and reward MSE curves of bf16 against fp32 on the same trajectories
+def measure_bf16_parity(datasource, encoder, decoder, transition, reward_pred, train_iter=0,
+                        timesteps=100, use_training_set=False):
+    trajectories = datasource.get_trajectories(batch_size=100, timesteps=timesteps, training=use_training_set)
+    with torch.no_grad():
+        with reduced_precision(enabled=False):
+            fp32_curves = measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred, train_iter,
+                                                 timesteps=timesteps, trajectories=trajectories, plot=False)
+        with reduced_precision():
+            bf16_curves = measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred, train_iter,
+                                                 timesteps=timesteps, trajectories=trajectories, plot=False)
+    if fp32_curves is None or bf16_curves is None:
+        return
+
+    parity = {}
+    for name, fp32_curve, bf16_curve in zip(['pixel', 'reward'], fp32_curves, bf16_curves):
+        fp32_curve, bf16_curve = np.array(fp32_curve), np.array(bf16_curve)
+        abs_diff = np.abs(bf16_curve - fp32_curve)
+        rel_diff = abs_diff / np.maximum(np.abs(fp32_curve), 1e-8)
+        print('bf16 vs fp32 {} MSE: max abs diff {:.5f} max rel diff {:.3f}'.format(name, abs_diff.max(), rel_diff.max()))
+        print(sparkline(list(abs_diff), length=80))
+        parity[name] = {
+            'fp32': fp32_curve.tolist(),
+            'bf16': bf16_curve.tolist(),
+            'max_abs_diff': float(abs_diff.max()),
+            'max_rel_diff': float(rel_diff.max()),
+        }
+    with open('bf16_parity_iter_{:06d}.json'.format(train_iter), 'w') as fp:
+        fp.write(json.dumps(parity, indent=2))
+    return parity
 
 
 # Apply a simple model-predictive control algorithm using the learned model,
@@ -327,6 +486,10 @@ def evaluate(datasource, encoder, decoder, transition, discriminator, reward_pre
 def play(latent_dim, datasource, num_actions, num_rewards, encoder, decoder,
          reward_predictor, discriminator, transition):
 
+    # Plan with the deterministic eval-mode models: Transition thresholds its
+    # latent instead of sampling it, whether or not planning is memoized
+    test_mode([encoder, decoder, transition, discriminator, reward_predictor])
+
     # Initialize environment
     env = datasource.make_env(screen_size=512)
 
@@ -341,9 +504,9 @@ def play(latent_dim, datasource, num_actions, num_rewards, encoder, decoder,
     state_list = [s_0, s_1, s_2]
 
     # Estimate initial state (given t=0,1,2 estimate state at t=2)
-    states = torch.Tensor(state_list).cuda().unsqueeze(0)
+    states = frames_to_tensor(state_list, device).unsqueeze(0)
     z = encoder(states)
-    z = transition(z, onehot(no_op, num_actions))
+    z = transition(z, action_indices(no_op))
 
     cumulative_reward = 0
     filename = 'SimpleRolloutAgent-{}.mp4'.format(int(time.time()))
@@ -351,22 +514,37 @@ def play(latent_dim, datasource, num_actions, num_rewards, encoder, decoder,
     t = 2
     cumulative_negative_reward = 0
     cumulative_positive_reward = 0
+    # Every first action, lookahead branch and rollout tail is simulated in one beam,
+    # which is kept and extended between steps while its predictions hold
+    decision_budget = args.decision_budget_ms / 1000 if args.decision_budget_ms is not None else None
+    table = None
+    if args.transposition_table_size:
+        table = TranspositionTable(args.transposition_table_size)
+    prune_bound = args.prune_bound
+    if args.admissible_pruning:
+        # Each reward type is a sum of per-pixel rewards in [-1, 1] over the reward head's output map
+        _, reward_map = reward_predictor(z, visualize=True)
+        prune_bound = admissible_prune_bound(reward_map[0, 0].numel(), num_rewards)
+    planner = RecedingHorizonPlanner(transition, reward_predictor, num_actions,
+                                     lookahead=args.lookahead, rollout_depth=args.rollout_depth,
+                                     rollout_policy='noop', replan_threshold=args.replan_threshold,
+                                     decision_budget=decision_budget, table=table,
+                                     prune_bound=prune_bound)
+    planning_depths = []
     while not done:
         z = z.detach()
         # In simulation, compute all possible futures to select the best action
-        rewards = []
-        for a in range(num_actions):
-            z_a = transition(z, onehot(a, num_actions))
-            # Look ahead three steps, using 3-step lookahead
-            r_a = compute_rollout_reward(z_a, transition, reward_predictor, num_actions, a,
-                                         rollout_depth=12, rollout_policy='noop')
-            rewards.append(r_a)
-            #print('Expected reward from taking action {} is {:.03f}'.format(a, r_a))
+        rewards = planner.plan(z).tolist()
+        planning_depths.append(planner.depth)
+        #for a, r_a in enumerate(rewards):
+        #    print('Expected reward from taking action {} is {:.03f}'.format(a, r_a))
         max_r = max(rewards)
+        # Actions with no branch left have value -inf and are never chosen
         max_a = int(np.argmax(rewards))
 
         # Take the best action, in real life
         new_state, new_reward, done, info = env.step(max_a)
+        planner.commit(max_a)
 
         if len(info) > 1:
             positive_reward = sum(v for v in info.values() if v > 0)
@@ -381,19 +559,26 @@ def play(latent_dim, datasource, num_actions, num_rewards, encoder, decoder,
 
         # Re-estimate state
         ftr_state, rgb_state = datasource.convert_frame(new_state)
-        print('t={} curr. r={:.02f} future r: {:.02f} {:.02f} {:.02f} {:.02f}'.format(t, cumulative_reward, rewards[0], rewards[1], rewards[2], rewards[3]))
+        print('t={} curr. r={:.02f} future r: {} depth {}'.format(t, cumulative_reward, format_action_values(rewards), planner.depth))
         caption = 'Negative Reward: {}    Positive Reward: {}'.format(int(cumulative_negative_reward), int(cumulative_positive_reward))
         print(caption)
         vid.write_frame(rgb_state, resize_to=(512,512), caption=caption)
 
         state_list = state_list[1:] + [ftr_state]
-        z = encoder(torch.Tensor(state_list).cuda().unsqueeze(0))
-        z = transition(z, onehot(max_a, num_actions))
+        z = encoder(frames_to_tensor(state_list, device).unsqueeze(0))
+        z = transition(z, action_indices(max_a))
         t += 1
         if t > 300:
             print('Ending evaluation due to time limit')
             break
     vid.finish()
+    print('Planner replanned {} times and reused its beam {} times'.format(planner.replans, planner.reuses))
+    if prune_bound is not None:
+        print('Planner pruned {} branches'.format(planner.pruned))
+    print('Planner depth: min {} mean {:.1f} max {}'.format(min(planning_depths), np.mean(planning_depths), max(planning_depths)))
+    if table is not None:
+        print('Transposition table: {} hits, {} misses, {} entries'.format(
+            table.hits, table.misses, len(table)))
     msg = 'Finished at t={} with cumulative reward {}'.format(t, cumulative_reward)
     with open('evaluation_metrics_{}.txt'.format(int(time.time())), 'w') as fp:
         fp.write(msg + '\n')
@@ -406,7 +591,7 @@ def generate_trajectory_video(datasource):
     vid = imutil.Video(filename, framerate=10)
     states, rewards, dones, infos = datasource.get_trajectories(batch_size=1)
     for state in states[0]:
-        img = state.transpose(1,2,0)
+        img = state.transpose(1,2,0).astype(float)
         vid.write_frame(img, resize_to=(256,256))
     vid.finish()
 
@@ -420,14 +605,14 @@ def generate_planning_visualization(z, transition, decoder, reward_predictor,
         actions = np.array([actions_list] * rollout_width)
     else:
         actions = np.random.randint(num_actions, size=(rollout_width, rollout_depth))
-    cumulative_rewards = torch.zeros(rollout_width).cuda()
+    actions = action_indices(actions)
+    cumulative_rewards = torch.zeros(rollout_width).to(device)
     frames = []
     z = z.repeat(rollout_width, 1, 1, 1)
     for t in range(rollout_depth):
-        z = transition(z, onehot(actions[:, t], num_actions))
+        z, rewards = simulate_step(z, actions[:, t], transition, reward_predictor)
         features = decoder(z)
         features = torch.sigmoid(features)
-        rewards = reward_predictor(z)
         cumulative_rewards += rewards[:, 1] - rewards[:, 0]
         mask = cumulative_rewards + 1
         mask = torch.clamp(mask, 0, 1)
@@ -444,49 +629,13 @@ def generate_planning_visualization(z, transition, decoder, reward_predictor,
     print('Simulation {} reward: {:.2f}'.format(r_argmax, r_max))
 
 
-def onehot(a_idx, num_actions=4):
+# Integer action indices on the device, as taken by Transition
+def action_indices(a_idx):
     if type(a_idx) is int:
-        # Usage: onehot(2)
-        return torch.eye(num_actions)[a_idx].unsqueeze(0).cuda()
-    # Usage: onehot([1,2,3])
-    return torch.eye(num_actions)[a_idx].cuda()
-
-
-def compute_rollout_reward(z, transition, reward_predictor, num_actions,
-                           selected_action, lookahead=2, rollout_depth=12,
-                           rollout_policy='noop', negative_positive_tradeoff=10.0):
-    rollout_width = num_actions ** lookahead
-    # Initialize a beam
-    z = z.repeat(rollout_width, 1, 1, 1)
-
-    # Use 3-step lookahead followed by a rollout policy
-    actions = []
-    for i in range(num_actions):
-        for j in range(num_actions):
-            # Test the 2-action sequence [i,j] and then roll out
-            if rollout_policy == 'noop':
-                noop_idx = 0
-                actions.append([i, j] + [noop_idx] * (rollout_depth - lookahead))
-            elif rollout_policy == 'random':
-                actions.append([i, j] + [np.random.randint(num_actions) for _ in range(rollout_depth - lookahead)])
-    actions = torch.LongTensor(np.array(actions)).cuda()
-    assert len(actions) == rollout_width
-
-    # Initialize a cumulative reward vector
-    cumulative_reward = reward_predictor(z)
-    # Starting from z, move forward in time and count the rewards
-    for t in range(rollout_depth):
-        z = z.detach()
-        z = transition(z, onehot(actions[:, t], num_actions))
-        cumulative_reward += reward_predictor(z)
-
-    # Heuristic, select level of "caution" about negative reward
-    cumulative_reward[:, 0] *= negative_positive_tradeoff
-
-    # Average among the rollouts
-    max_r, max_idx = cumulative_reward.sum(dim=1).max(dim=0)
-    #print('Best possible reward {:.2f} from rollout: {}'.format(max_r, actions[max_idx, :3]))
-    return max_r
+        # Usage: action_indices(2)
+        a_idx = [a_idx]
+    # Usage: action_indices([1,2,3])
+    return torch.as_tensor(np.asarray(a_idx), dtype=torch.long, device=device)
 
 
 def test_mode(networks):
@@ -509,14 +658,17 @@ def format_reward_vector(reward):
     return ' '.join(['{:.2f}'.format(r) for r in reward])
 
 
-def compute_causal_graph(encoder, transition, datasource, iter=0):
-    # Max over 10 runs
-    weights_runs = []
-    for i in range(10):
-        src_z, onehot_a = sample_transition(encoder, transition, datasource)
-        causal_edge_weights = compute_causal_edge_weights(src_z, transition, onehot_a)
-        weights_runs.append(causal_edge_weights)
-    causal_edge_weights = np.max(weights_runs, axis=0)
+# Actions with no branch left in the planner's beam (pruned, or dropped when the
+# beam was reused) have no value, and are shown as -
+def format_action_values(values):
+    return ' '.join(['{:.02f}'.format(v) if math.isfinite(v) else '-' for v in values])
+
+
+def compute_causal_graph(encoder, transition, datasource, iter=0, num_runs=10):
+    # Max over 10 runs, all sampled and ablated together as one batch
+    with torch.no_grad():
+        src_z, a = sample_transition(encoder, transition, datasource, batch_size=32 * num_runs)
+        causal_edge_weights = compute_causal_edge_weights(src_z, transition, a, num_runs=num_runs)
     imutil.show(causal_edge_weights, resize_to=(256,256),
                 filename='causal_matrix_iter_{:06d}.png'.format(iter))
 
@@ -535,55 +687,60 @@ def sample_transition(encoder, transition, datasource, batch_size=32):
     horizon = 5  # 3 frame encoder input followed by two predicted steps
     num_actions = datasource.binary_input_channels
     states, rewards, dones, actions = datasource.get_trajectories(batch_size, horizon)
-    states = torch.Tensor(states).cuda()
-    rewards = torch.Tensor(rewards).cuda()
-    dones = torch.Tensor(dones.astype(int)).cuda()
+    states = frames_to_tensor(states, device)
+    rewards = torch.Tensor(rewards).to(device)
+    dones = torch.Tensor(dones.astype(int)).to(device)
 
     # Start with latent point t=3
     z = encoder(states[:, 0:3])
-    z = transition(z, torch.eye(num_actions)[actions[:,2]].cuda())
+    actions = action_indices(actions)
+    z = transition(z, actions[:, 2])
     latent_dim = z.shape[1]
 
     # Now discard t=3 because the agent gets ground truth for it
     # Compare z at t=4 and t=5, the first two predicted timesteps
-    src_z = transition(z, torch.eye(num_actions)[actions[:, 3]].cuda())
-    onehot_a = torch.eye(num_actions)[actions[:, 4]].cuda()
-    return src_z, onehot_a
+    src_z = transition(z, actions[:, 3])
+    return src_z, actions[:, 4]
 
 
-def compute_causal_edge_weights(src_z, transition, onehot_a):
-    latent_dim = src_z.shape[1]
-    dst_z = transition(src_z, onehot_a)
+# The batch holds num_runs equal-sized runs; each run's edge weights are
+# normalized to max 1, and the max over runs is returned
+# The ablated copies of the whole batch go through the transition in passes of
+# at most max_batch latents, to bound activation memory; the reductions stay on
+# the device and the result is copied to the host once
+def compute_causal_edge_weights(src_z, transition, a, num_runs=1, max_batch=512):
+    batch_size, latent_dim = src_z.shape[:2]
 
-    # Edge weights for the causal graph: close-to-zero weights can be pruned
-    causal_edge_weights = np.zeros(shape=(latent_dim, latent_dim))
+    # The next timestep (according to our model)
+    ground_truth_outcome = transition(src_z, a)
 
     # For each latent factor, check which other factors it "causes"
     # by computing a counterfactual s_{t+1}
-    #print("Generating counterfactual perturbations for latent factors dim {}".format(latent_dim))
-    for src_factor_idx in range(latent_dim):
-        # The next timestep (according to our model)
-        ground_truth_outcome = dst_z
-
-        # What if z[:,latent_idx] had been erased, set to zero?
-        perturbed_src_z = src_z.clone()
-        perturbed_src_z[:, src_factor_idx] = 0
-
-        # The counterfactual next timestep (according to our model)
-        counterfactual_outcome = transition(perturbed_src_z, onehot_a)
+    # Ablation i asks: what if z[:,i] had been erased, set to zero?
+    ablation_masks = 1 - torch.eye(latent_dim, device=src_z.device)
+    ablations_per_pass = max(1, max_batch // batch_size)
+    edge_weights = []
+    for masks in ablation_masks.split(ablations_per_pass):
+        perturbed_src_z = src_z.unsqueeze(0) * masks.reshape(len(masks), 1, latent_dim, 1, 1)
+        perturbed_src_z = perturbed_src_z.reshape((-1,) + src_z.shape[1:])
+
+        # The counterfactual next timesteps (according to our model)
+        counterfactual_outcomes = transition(perturbed_src_z, a.repeat(len(masks)))
+        counterfactual_outcomes = counterfactual_outcomes.reshape((len(masks),) + ground_truth_outcome.shape)
 
         # Difference between what we normally expect to happen,
         #  and what *would* happen IF NOT FOR the source factor
-        cf_difference = (ground_truth_outcome - counterfactual_outcome)**2
-        for dst_factor_idx in range(latent_dim):
-            edge_weight = float(cf_difference[:,dst_factor_idx].max())
-            #print("Factor {} -> Factor {} causal strength: {:.04f}".format(src_factor_idx, dst_factor_idx, edge_weight))
-            causal_edge_weights[src_factor_idx, dst_factor_idx] = edge_weight
-    #print("Finished generating counterfactual perturbations")
+        cf_difference = (ground_truth_outcome.unsqueeze(0) - counterfactual_outcomes)**2
 
-    #print("Normalizing counterfactual perturbations to max {}".format(causal_edge_weights.max()))
-    causal_edge_weights /= causal_edge_weights.max()
-    return causal_edge_weights
+        # Max over each run's examples and pixels gives (src, run, dst)
+        cf_difference = cf_difference.reshape(len(masks), num_runs, batch_size // num_runs, latent_dim, -1)
+        edge_weights.append(cf_difference.max(dim=-1)[0].max(dim=2)[0])
+
+    # Edge weights for the causal graph: close-to-zero weights can be pruned
+    edge_weights = torch.cat(edge_weights).transpose(0, 1)
+    edge_weights = edge_weights / edge_weights.reshape(num_runs, -1).max(dim=1)[0].reshape(num_runs, 1, 1)
+    causal_edge_weights = edge_weights.max(dim=0)[0]
+    return causal_edge_weights.cpu().numpy()
 
 
 def visualize_reconstruction(datasource, encoder, decoder, transition, reward_predictor, train_iter=0):
@@ -592,9 +749,9 @@ def visualize_reconstruction(datasource, encoder, decoder, transition, reward_pr
     timesteps = 45
     batch_size = 1
     states, rewards, dones, actions = datasource.get_trajectories(batch_size, timesteps, random_start=False)
-    states = torch.Tensor(states).cuda()
-    rewards = torch.Tensor(rewards).cuda()
-    actions = torch.LongTensor(actions).cuda()
+    states = frames_to_tensor(states, device)
+    rewards = torch.Tensor(rewards).to(device)
+    actions = torch.LongTensor(actions).to(device)
     offsets = [1, 3]
     print('Generating videos for offsets {}'.format(offsets))
     for offset in offsets:
@@ -605,12 +762,11 @@ def visualize_reconstruction(datasource, encoder, decoder, transition, reward_pr
             # Encode frames t-2, t-1, t to produce state at t-1
             # Then step forward once to produce state at t
             z = encoder(states[:, t-2:t+1])
-            z = transition(z, torch.eye(num_actions)[actions[:, t - 1]].cuda())
+            z = transition(z, actions[:, t - 1])
 
             # Now step forward *offset* times to produce state at t+offset
             for t_i in range(t, t + offset):
-                onehot_a = torch.eye(num_actions)[actions[:, t_i]].cuda()
-                z = transition(z, onehot_a)
+                z = transition(z, actions[:, t_i])
 
             # Our prediction of the world from 'offset' steps back
             predicted_features = decoder(z)
@@ -664,8 +820,8 @@ def composite_rgb_reward_factor_image(x_t_pixels, reward_map, z, num_rewards=4):
 
     simulated_rgb = imutil.get_pixels(x_t_pixels * 255, 512, 512, normalize=False)
 
-    reward_positive = reward_map[0] * (reward_map[0] > 0).type(torch.cuda.FloatTensor)
-    reward_negative = -reward_map[0] * (reward_map[0] < 0).type(torch.cuda.FloatTensor)
+    reward_positive = reward_map[0] * (reward_map[0] > 0).float()
+    reward_negative = -reward_map[0] * (reward_map[0] < 0).float()
     red_map = imutil.get_pixels(reward_negative.sum(dim=0) * 255, 512, 512, normalize=False)
     red_map[:, :, 1:] = 0
     blue_map = imutil.get_pixels(reward_positive.sum(dim=0) * 255, 512, 512, normalize=False)
@@ -673,7 +829,7 @@ def composite_rgb_reward_factor_image(x_t_pixels, reward_map, z, num_rewards=4):
 
     reward_overlay_simulation = np.clip(simulated_rgb + red_map + blue_map, 0, 255)
 
-    feature_maps = imutil.get_pixels(z[0], 512, 512, img_padding=4) * 255
+    feature_maps = imutil.get_pixels(z[0].float(), 512, 512, img_padding=4) * 255
     composite_visual = np.concatenate([reward_overlay_simulation, feature_maps], axis=1)
     return composite_visual
 
@@ -690,7 +846,7 @@ def composite_aleatoric_surprise_image(x_t_pixels, surprise_map, z, num_factors
 
     reward_overlay_simulation = np.clip(simulated_rgb + green_map, 0, 255)
 
-    feature_maps = imutil.get_pixels(z[0], 512, 512, img_padding=4) * 255
+    feature_maps = imutil.get_pixels(z[0].float(), 512, 512, img_padding=4) * 255
     composite_visual = np.concatenate([reward_overlay_simulation, feature_maps], axis=1)
     return composite_visual
 
@@ -699,14 +855,14 @@ def visualize_forward_simulation(datasource, encoder, decoder, transition, rewar
     start_time = time.time()
     print('Starting trajectory simulation for {} frames'.format(timesteps))
     states, rewards, dones, actions = datasource.get_trajectories(batch_size=1, timesteps=timesteps, random_start=False)
-    states = torch.Tensor(states).cuda()
+    states = frames_to_tensor(states, device)
     num_actions = datasource.binary_input_channels
     num_rewards = datasource.scalar_output_channels
-    # rgb_states = torch.Tensor(rgb_states.transpose(0, 1, 4, 2, 3)).cuda()
+    # rgb_states = torch.Tensor(rgb_states.transpose(0, 1, 4, 2, 3)).to(device)
     # We begin *at* state t=2, then we simulate from t=2 until t=timesteps
     # Encoder input is t=0, t=1, t=2 to produce t=1
     z = encoder(states[:, :3])
-    z = transition(z, torch.eye(num_actions)[actions[:, 1]].cuda())
+    z = transition(z, action_indices(actions[:, 1]))
     z.detach()
 
     ftr_vid = imutil.Video('simulation_ftr_iter_{:06d}.mp4'.format(train_iter), framerate=3)
@@ -760,8 +916,7 @@ def simulate_trajectory_from_actions(z, decoder, reward_pred, transition,
         #    factor_vids[z_i].write_frame(factor_vis * 255, normalize=False)
 
         # Predict the next latent point
-        onehot_a = torch.eye(num_actions)[actions[:, t]].cuda()
-        z = transition(z, onehot_a).detach()
+        z = transition(z, action_indices(actions[:, t])).detach()
 
         if dones[0, t]:
             break
@@ -781,22 +936,27 @@ def convert_ndim_image_to_rgb(x):
     return x.sum(dim=1).unsqueeze(1).repeat(1,3,1,1)
 
 
+# Returns the per-timestep pixel and reward MSE curves
+# Pass trajectories to measure on a fixed set of (states, rewards, dones, actions)
 def measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred,
                            train_iter=0, timesteps=100, num_factors=16, experiment_name='default',
-                           use_training_set=False):
+                           use_training_set=False, trajectories=None, plot=True):
     batch_size = 100
     start_time = time.time()
     num_actions = datasource.binary_input_channels
     num_rewards = datasource.scalar_output_channels
-    states, rewards, dones, actions = datasource.get_trajectories(batch_size=batch_size, timesteps=timesteps, training=use_training_set)
-    states = torch.Tensor(states).cuda()
-    rewards = torch.Tensor(rewards).cuda()
-    dones = torch.Tensor(dones.astype(int)).cuda()
+    if trajectories is None:
+        trajectories = datasource.get_trajectories(batch_size=batch_size, timesteps=timesteps, training=use_training_set)
+    states, rewards, dones, actions = trajectories
+    states = frames_to_tensor(states, device)
+    rewards = torch.Tensor(rewards).to(device)
+    dones = torch.Tensor(dones.astype(int)).to(device)
+    actions = action_indices(actions)
 
     # We begin *at* state t=2, then we simulate from t=2 until t=timesteps
     # Encoder input is t=0, t=1, t=2 to produce t=1
     z = encoder(states[:, :3])
-    z = transition(z, torch.eye(num_actions)[actions[:, 1]].cuda())
+    z = transition(z, actions[:, 1])
     z.detach()
 
     # Simulate the future, compare with reality
@@ -804,7 +964,7 @@ def measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred
     mse_stddevs = []
     reward_losses = []
     reward_stddevs = []
-    active_mask = torch.ones(batch_size).cuda()
+    active_mask = torch.ones(batch_size).to(device)
     for t in range(2, timesteps):
         active_mask = active_mask * (1 - dones[:, t])
         if sum(active_mask) == 0:
@@ -831,7 +991,7 @@ def measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred
         #mae_loss = torch.mean(torch.abs(expected - predicted))
         #print('MAE t={} {:.04f}\n'.format(t, mae_loss))
         #mae_losses.append(float(mae_loss))
-        z = transition(z, torch.eye(num_actions)[actions[:, t]].cuda())
+        z = transition(z, actions[:, t])
         z.detach_()
     if len(mse_losses) == 0:
         print('Degenerate trajectory, skipping MSE calculation')
@@ -844,6 +1004,8 @@ def measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred
     print(sparkline(reward_losses, length=80))
     print('Avg. MSE loss: {}'.format(np.mean(reward_losses)))
     print('Finished trajectory simulation in {:.02f}s'.format(time.time() - start_time))
+    if not plot:
+        return mse_losses, reward_losses
 
     plot_error_graph(mse_losses, mse_stddevs, experiment_name='pixel',
                      train_iter=train_iter,
@@ -853,6 +1015,7 @@ def measure_prediction_mse(datasource, encoder, decoder, transition, reward_pred
                      train_iter=train_iter,
                      facecolor='#FFFF00', edgecolor='#FFFF00',
                      title='Prediction Error vs. Time (Reward)')
+    return mse_losses, reward_losses
 
 
 def plot_error_graph(mse_losses, mse_stddevs, experiment_name, train_iter, title='',
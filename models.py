@@ -21,9 +21,9 @@ ENCODER_INPUT_FRAMES = 3
 #ts = TimeSeries('Profiling')
 
 
-def random_eps(p=0.5, batch_size=32, height=64, width=64, channels=NOISE_DIM):
+def random_eps(p=0.5, batch_size=32, height=64, width=64, channels=NOISE_DIM, device='cuda'):
     shape = (batch_size, height, width, channels)
-    return torch.bernoulli(torch.ones(shape) * p).cuda()
+    return torch.bernoulli(torch.ones(shape, device=device) * p)
 
 
 from torch.autograd import Function
@@ -40,40 +40,57 @@ class DifferentiableBernoulliSampler(Function):
         return grad_output
 
 
+# Like DifferentiableBernoulliSampler, but replays a sample drawn earlier
+class ReplayedBernoulliSampler(Function):
+    @staticmethod
+    def forward(ctx, x, sample):
+        return sample.to(x.dtype, copy=True)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
 class Transition(nn.Module):
-    def __init__(self, latent_size, num_actions):
+    def __init__(self, latent_size, num_actions, device='cuda'):
         super().__init__()
         # Input: State + Action
         # Output: State
         self.latent_size = latent_size
 
         # Skip connections from output of 1 to input of 6, and output of 2 to input of 5
-        self.conv1 = SpectralNorm(nn.Conv2d(latent_size + num_actions, 128, (3,3), stride=1, padding=2, padding_mode='circular'))
-        self.conv2 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=2, padding_mode='circular'))
-        self.conv3 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=2, padding_mode='circular'))
-        self.conv4 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=2, padding_mode='circular'))
-        self.conv5 = SpectralNorm(nn.Conv2d(128 + 128, 128, (3,3), stride=1, padding=2, padding_mode='circular'))
-        self.conv6 = nn.Conv2d(128 + 128, latent_size, (3,3), stride=1, padding=2, padding_mode='circular')
-        self.cuda()
-
-    def forward(self, s, a, return_all=False):
+        self.conv1 = SpectralNorm(nn.Conv2d(latent_size + num_actions, 128, (3,3), stride=1, padding=1, padding_mode='circular'))
+        self.conv2 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=1, padding_mode='circular'))
+        self.conv3 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=1, padding_mode='circular'))
+        self.conv4 = SpectralNorm(nn.Conv2d(128, 128, (3,3), stride=1, padding=1, padding_mode='circular'))
+        self.conv5 = SpectralNorm(nn.Conv2d(128 + 128, 128, (3,3), stride=1, padding=1, padding_mode='circular'))
+        self.conv6 = nn.Conv2d(128 + 128, latent_size, (3,3), stride=1, padding=1, padding_mode='circular')
+        self.to(device)
+
+    # Actions a are either a (batch_size, num_actions) one-hot encoding,
+    # or a (batch_size,) tensor of integer action indices
+    # If given, sample replaces the sampled or thresholded output, with the
+    # same straight-through gradient, to re-simulate a known trajectory
+    def forward(self, s, a, return_all=False, sample=None):
         start_time = time.time()
 
         actions = a
         z_map = s
         batch_size, z, height, width = z_map.shape
-        batch_size_actions, num_actions = actions.shape
-        assert batch_size == batch_size_actions
+        assert batch_size == actions.shape[0]
 
-        # Broadcast the actions across the convolutional map
-        actions = actions.unsqueeze(-1).unsqueeze(-1)
-        actions = actions.repeat(1, 1, height, width)
+        if actions.dtype.is_floating_point:
+            # Broadcast the actions across the convolutional map
+            actions = actions.unsqueeze(-1).unsqueeze(-1)
+            actions = actions.repeat(1, 1, height, width)
 
-        # Stack the latent values, the actions, and random chance
-        x = torch.cat([z_map, actions], dim=1)
+            # Stack the latent values, the actions, and random chance
+            x = torch.cat([z_map, actions], dim=1)
+            x = self.conv1(x)
+        else:
+            x = self.conv1_indexed(z_map, actions)
 
         # Convolve down, saving skip activations like U-net
-        x = self.conv1(x)
         x = F.leaky_relu(x)
         skip1 = x.clone()
 
@@ -104,7 +121,9 @@ class Transition(nn.Module):
 
         # And now, to make it stochastic: sample from the resulting
         # factorized multivariate Bernoulli distribution
-        if self.training:
+        if sample is not None:
+            x = ReplayedBernoulliSampler.apply(x, sample)
+        elif self.training:
             x = DifferentiableBernoulliSampler.apply(x)
             pass
         else:
@@ -118,10 +137,27 @@ class Transition(nn.Module):
             return (skip1, skip2, out3, out4, out5, x)
         return x
 
+    # conv1 applied to the latent map stacked with a broadcast one-hot action map,
+    # computed without building the action map: with circular padding, every input
+    # window sees the same constant action channels, so their contribution is a
+    # per-action bias equal to the sum of that action's kernel weights
+    def conv1_indexed(self, z_map, actions):
+        if isinstance(self.conv1, SpectralNorm):
+            conv, weight = self.conv1.module, self.conv1.normalized_weight()
+        else:
+            conv, weight = self.conv1, self.conv1.weight
+        assert conv.padding_mode == 'circular'
+        latent_weight, action_weight = weight[:, :self.latent_size], weight[:, self.latent_size:]
+        pad_h, pad_w = conv.padding
+        x = F.pad(z_map, (pad_w, pad_w, pad_h, pad_h), mode='circular')
+        x = F.conv2d(x, latent_weight, conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+        action_bias = action_weight.sum(dim=(2, 3)).t().to(x.dtype)
+        return x + action_bias[actions].unsqueeze(-1).unsqueeze(-1)
+
 
 
 class Encoder(nn.Module):
-    def __init__(self, latent_size, color_channels):
+    def __init__(self, latent_size, color_channels, device='cuda'):
         super().__init__()
         self.latent_size = latent_size
         self.color_channels = color_channels
@@ -134,13 +170,13 @@ class Encoder(nn.Module):
         self.conv4 = nn.Conv2d(128, latent_size, (3,3), stride=1, padding=1)
 
         # Bxlatent_size
-        self.cuda()
+        self.to(device)
 
     def forward(self, x):
         # Input: B x 1 x 64 x 64
         start_time = time.time()
         batch_size, frames, channels, height, width = x.shape
-        x = x.view(batch_size, frames*channels, height, width)
+        x = x.reshape(batch_size, frames*channels, height, width)
 
         x = self.conv1(x)
         x = F.leaky_relu(x)
@@ -165,21 +201,21 @@ class Encoder(nn.Module):
 # The discriminator solves #1 and this network solves #2
 #
 class Inverter(nn.Module):
-    def __init__(self, latent_size):
+    def __init__(self, latent_size, device='cuda'):
         super().__init__()
         self.latent_size = latent_size
         self.conv1 = nn.Conv2d(latent_size * 2, 32, (3,3), stride=1, padding=1)
         self.conv2 = SpectralNorm(nn.Conv2d(32, NOISE_DIM, (3,3), stride=1, padding=0))
 
         # Bxlatent_size
-        self.cuda()
+        self.to(device)
 
     # Given s_{t-1}, s_t, a_{t}, infer \epsilon_{t-1}
     def forward(self, s_curr, s_next, a):
         # Input: B x 1 x 64 x 64
         start_time = time.time()
         batch_size, frames, channels, height, width = x.shape
-        x = x.view(batch_size, frames*channels, height, width)
+        x = x.reshape(batch_size, frames*channels, height, width)
 
         x = self.conv1(x)
         x = F.leaky_relu(x)
@@ -193,7 +229,7 @@ class Inverter(nn.Module):
 # Input: A noise map, either output by the NoiseRecognizer or drawn from the noise prior
 # Output: Linear unit for a binary classification, random or not random
 class Discriminator(nn.Module):
-    def __init__(self):
+    def __init__(self, device='cuda'):
         super().__init__()
         # Bx1x64x64
         self.conv1 = SpectralNorm(nn.Conv2d(NOISE_DIM, 32, (3, 3), stride=2, padding=0))
@@ -203,7 +239,7 @@ class Discriminator(nn.Module):
         self.conv3 = nn.Conv2d(32, 32, (3,3), stride=2, padding=0)
 
         self.fc1 = nn.Linear(32*7*7, 1)
-        self.cuda()
+        self.to(device)
 
     def forward(self, x):
         # Input: B x 1 x 64 x 64
@@ -225,12 +261,12 @@ class Discriminator(nn.Module):
 
 class RewardPredictor(nn.Module):
     # Predicts multiple reward types, if you have multiple reward signals
-    def __init__(self, latent_dim, num_rewards):
+    def __init__(self, latent_dim, num_rewards, device='cuda'):
         super().__init__()
         self.conv1 = nn.Conv2d(latent_dim, 32, (3,3), stride=1, padding=0)
         # Each reward is discretized into a 3-way classification: +1, -1, or 0
         self.conv2 = nn.Conv2d(32, num_rewards * 3, (3,3), stride=2, padding=0)
-        self.cuda()
+        self.to(device)
 
     def forward(self, x, visualize=False):
         start_time = time.time()
@@ -239,8 +275,10 @@ class RewardPredictor(nn.Module):
         x = self.conv2(x)
 
         # Classify each pixel as +1, -1, or 0 (for each reward type)
+        # The softmax and the sum over pixels run in float32, even under reduced-precision autocast
+        x = x.float()
         batch_size, channels, height, width = x.shape
-        x = x.view(batch_size, 3, channels // 3, height, width)
+        x = x.reshape(batch_size, 3, channels // 3, height, width)
         x = torch.softmax(x, dim=1)
         # Return the cumulative reward (for each reward type)
         x = x[:, 0] - x[:, 2]
@@ -251,7 +289,7 @@ class RewardPredictor(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, latent_size, color_channels):
+    def __init__(self, latent_size, color_channels, device='cuda'):
         super().__init__()
         self.latent_size = latent_size
         self.color_channels = color_channels
@@ -265,7 +303,7 @@ class Decoder(nn.Module):
                                         latent_size*self.color_channels, (3,3),
                                         stride=1, padding=1)
         #self.bg = nn.Parameter(torch.zeros((3, IMG_SIZE, IMG_SIZE)).cuda())
-        self.cuda()
+        self.to(device)
 
     def forward(self, z_map, visualize=False):
         start_time = time.time()
@@ -276,8 +314,8 @@ class Decoder(nn.Module):
         x = F.leaky_relu(x)
 
         x = self.conv2(x)
-        # Sum the separate items
-        x = x.view(batch_size, latent_size, self.color_channels, height, width)
+        # Sum the separate items, in float32 even under reduced-precision autocast
+        x = x.float().reshape(batch_size, latent_size, self.color_channels, height, width)
 
         # Optional: Learn to subtract static background, separate from objects
         #x = x + self.bg
@@ -292,11 +330,11 @@ class Decoder(nn.Module):
 
 
 class RGBDecoder(nn.Module):
-    def __init__(self, color_channels=3, img_size=256):
+    def __init__(self, color_channels=3, img_size=256, device='cuda'):
         super().__init__()
         #self.conv1 = nn.ConvTranspose2d(color_channels, 32, (4,4), stride=2, padding=1)
         #self.conv2 = nn.ConvTranspose2d(32, 3, (4,4), stride=2, padding=1)
-        self.bg = nn.Parameter(torch.zeros((color_channels, img_size, img_size)).cuda())
+        self.bg = nn.Parameter(torch.zeros((color_channels, img_size, img_size), device=device))
         #self.cuda()
 
     def forward(self, x, enable_bg=True):
@@ -325,7 +363,7 @@ class GaussianSmoothing(nn.Module):
         dim (int, optional): The number of dimensions of the data.
             Default value is 2 (spatial).
     """
-    def __init__(self, channels, kernel_size, sigma, dim=2):
+    def __init__(self, channels, kernel_size, sigma, dim=2, device='cuda'):
         super(GaussianSmoothing, self).__init__()
         self.padding = [int(kernel_size / 2)] * dim
         kernel_size = [kernel_size] * dim
@@ -365,7 +403,7 @@ class GaussianSmoothing(nn.Module):
             raise RuntimeError(
                 'Only 1, 2 and 3 dimensions are supported. Received {}.'.format(dim)
             )
-        self.cuda()
+        self.to(device)
 
     def forward(self, input):
         """
@@ -2,41 +2,167 @@ import gym
 import numpy as np
 import imutil
 import time
+import multiprocessing
 from concurrent import futures
 
+from replay_buffer import shared_array
 
-def map_fn(fn, *iterables):
-    with futures.ThreadPoolExecutor(max_workers=4) as executor:
-        result_iterator = executor.map(fn, *iterables)
-    return [i for i in result_iterator]
+# Process workers are forked, so each one inherits its share of the environments
+mp = multiprocessing.get_context('fork')
 
 
+# Step a chunk of environments, writing results into the given (chunk_size, ...) arrays
+def step_envs(envs, actions, states, rewards, dones):
+    infos = []
+    for i, (env, action) in enumerate(zip(envs, actions)):
+        state, reward, done, info = env.step(action)
+        if done:
+            env.reset()
+        states[i] = state
+        rewards[i] = reward
+        dones[i] = done
+        infos.append(info)
+    return infos
+
+
+def reset_envs(envs, states):
+    for i, env in enumerate(envs):
+        states[i] = env.reset()
+
+
+# Each process worker owns one chunk of environments and steps it on request
+# Results are written into the shared output arrays; only infos go through the pipe
+def env_worker(envs, chunk, conn, states, rewards, dones):
+    while True:
+        command, actions = conn.recv()
+        if command == 'step':
+            conn.send(step_envs(envs, actions, states[chunk], rewards[chunk], dones[chunk]))
+        elif command == 'reset':
+            reset_envs(envs, states[chunk])
+            conn.send(None)
+        elif command == 'close':
+            conn.close()
+            break
+
+
+# Steps a batch of environments with a long-lived pool of workers
+# The batch is split into one contiguous chunk of environments per worker.
+# backend='thread' steps chunks in a thread pool; backend='process' steps them in
+# forked subprocesses that write into shared memory, for GIL-bound environments.
+# With the process backend the environments live in the workers: the objects in
+# self.envs are not stepped.
 class MultiEnvironment():
-    def __init__(self, envs):
+    def __init__(self, envs, backend='thread', num_workers=4):
         start_time = time.time()
         self.batch_size = len(envs)
         self.envs = envs
-        self.reset()
+        self.backend = backend
         self.action_space = self.envs[0].action_space
+        num_workers = max(1, min(num_workers, self.batch_size))
+        bounds = np.linspace(0, self.batch_size, num_workers + 1).astype(int)
+        self.chunks = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+        # The first state determines the shape and dtype of the state outputs
+        state = np.asarray(self.envs[0].reset())
+        self.state_shape = state.shape
+        self.state_dtype = state.dtype
+        # The reward shape comes from a probe step, undone by the reset below: some
+        # environments return a vector of rewards. Rewards are always stored as float32,
+        # since a first reward of int 0 says nothing about the rewards that follow
+        _, reward, _, _ = self.envs[0].step(self.action_space.sample())
+        self.reward_shape = np.shape(reward)
+        self.closed = False
+
+        if backend == 'thread':
+            self.executor = futures.ThreadPoolExecutor(max_workers=num_workers)
+        elif backend == 'process':
+            self.states, self.rewards, self.dones = self.allocate_outputs(shared=True)
+            self.conns = []
+            self.workers = []
+            for chunk in self.chunks:
+                conn, worker_conn = mp.Pipe()
+                args = (self.envs[chunk], chunk, worker_conn, self.states, self.rewards, self.dones)
+                worker = mp.Process(target=env_worker, args=args)
+                worker.daemon = True  # hack to kill on ctrl+C
+                worker.start()
+                self.conns.append(conn)
+                self.workers.append(worker)
+        else:
+            raise ValueError('Unknown MultiEnvironment backend {}'.format(backend))
+        self.reset()
         #print('Initialized {} environments in {:.03f}s'.format(self.batch_size, time.time() - start_time))
 
-    def reset(self):
-        return map_fn(lambda env: env.reset(), self.envs)
+    # Arrays of shape (batch_size, ...) for states, rewards and dones
+    def allocate_outputs(self, shared=False):
+        new_array = shared_array if shared else np.zeros
+        states = new_array((self.batch_size,) + self.state_shape, self.state_dtype)
+        rewards = new_array((self.batch_size,) + self.reward_shape, np.float32)
+        dones = new_array(self.batch_size, bool)
+        return states, rewards, dones
 
-    def step(self, actions):
+    def reset(self, out=None):
+        if out is None:
+            out = np.zeros((self.batch_size,) + self.state_shape, self.state_dtype)
+        if self.backend == 'process':
+            for conn in self.conns:
+                conn.send(('reset', None))
+            for conn in self.conns:
+                conn.recv()
+            out[:] = self.states
+        else:
+            jobs = [self.executor.submit(reset_envs, self.envs[chunk], out[chunk]) for chunk in self.chunks]
+            for job in jobs:
+                job.result()
+        return out
+
+    # Results are written in place into out, a tuple of (states, rewards, dones) arrays
+    # of shape (batch_size, ...), or into newly allocated arrays if out is None
+    def step(self, actions, out=None):
         start_time = time.time()
         #assert len(actions) == len(self.envs)
+        actions = np.asarray(actions)
+        if out is None:
+            out = self.allocate_outputs()
+        states, rewards, dones = out
 
-        def run_one_step(env, action):
-            state, reward, done, info = env.step(action)
-            if done:
-                env.reset()
-            return state, reward, done, info
-
-        results = map_fn(run_one_step, self.envs, actions)
-        states, rewards, dones, infos = zip(*results)
+        if self.backend == 'process':
+            for conn, chunk in zip(self.conns, self.chunks):
+                conn.send(('step', actions[chunk]))
+            infos = []
+            for conn in self.conns:
+                infos.extend(conn.recv())
+            states[:] = self.states
+            rewards[:] = self.rewards
+            dones[:] = self.dones
+        else:
+            jobs = []
+            for chunk in self.chunks:
+                args = (self.envs[chunk], actions[chunk], states[chunk], rewards[chunk], dones[chunk])
+                jobs.append(self.executor.submit(step_envs, *args))
+            infos = []
+            for job in jobs:
+                infos.extend(job.result())
         #print('Ran {} environments one step in {:.03f}s'.format(self.batch_size, time.time() - start_time))
-        return np.array(states), np.array(rewards), np.array(dones), infos
+        return states, rewards, dones, tuple(infos)
+
+    # Shuts down the worker threads or processes; also called on leaving a with block
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.backend == 'process':
+            for conn in self.conns:
+                conn.send(('close', None))
+            for worker in self.workers:
+                worker.join()
+        else:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 if __name__ == '__main__':
@@ -50,3 +176,4 @@ if __name__ == '__main__':
         print('Step {}, Average reward {:.02f}'.format(i, np.mean(rewards)))
         imutil.show(states)
         time.sleep(1)
+    env.close()
@@ -0,0 +1,299 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+# A beam of imagined rollouts from one root state. For each branch it holds the
+# actions taken, the latent state reached after each action (stored as bool:
+# Transition outputs exact 0/1 maps), and the reward predicted at each state
+class Beam():
+    def __init__(self, actions, states, rewards, dtype=torch.float32, pruned=0):
+        self.actions = actions  # branches x depth
+        self.states = states  # branches x depth x latent_dim x height x width
+        self.rewards = rewards  # branches x depth x num_rewards
+        self.dtype = dtype
+        # Branches dropped by branch-and-bound while the beam was built
+        self.pruned = pruned
+
+    def __len__(self):
+        return len(self.actions)
+
+    # The latent states after the last action of each branch
+    def final_states(self):
+        return self.states[:, -1].to(self.dtype)
+
+    # Keep only the branches where keep is True
+    def select(self, keep):
+        return Beam(self.actions[keep], self.states[keep], self.rewards[keep], self.dtype)
+
+    # Drop the first step of every branch and append one more step to it
+    def shift(self, actions, states, rewards):
+        return Beam(torch.cat([self.actions[:, 1:], actions.unsqueeze(1)], dim=1),
+                    torch.cat([self.states[:, 1:], states.bool().unsqueeze(1)], dim=1),
+                    torch.cat([self.rewards[:, 1:], rewards.unsqueeze(1)], dim=1),
+                    self.dtype)
+
+    # Rollout steps after the first action
+    def depth(self):
+        return self.actions.shape[1] - 1
+
+    def action_values(self, num_actions, negative_positive_tradeoff=10.0):
+        return action_values(self.actions[:, 0], self.rewards.sum(dim=1),
+                             num_actions, negative_positive_tradeoff)
+
+
+# The value of each first action: the cumulative reward of its best branch, with
+# negative reward weighted by negative_positive_tradeoff. Actions that begin no
+# branch get -inf
+def action_values(first_actions, cumulative_reward, num_actions, negative_positive_tradeoff=10.0):
+    values = branch_values(cumulative_reward, negative_positive_tradeoff)
+
+    actions = torch.arange(num_actions, device=values.device)
+    is_first_action = first_actions.unsqueeze(0) == actions.unsqueeze(1)
+    no_value = torch.full_like(values, -float('inf'))
+    return torch.where(is_first_action, values.unsqueeze(0), no_value.unsqueeze(0)).max(dim=1)[0]
+
+
+def branch_values(cumulative_reward, negative_positive_tradeoff=10.0):
+    # Heuristic, select level of "caution" about negative reward
+    cumulative_reward = cumulative_reward.clone()
+    cumulative_reward[:, 0] *= negative_positive_tradeoff
+    return cumulative_reward.sum(dim=1)
+
+
+# An admissible prune_bound for a reward head that sums per-pixel rewards in
+# [-1, 1] over reward_pixels pixels, for each of num_rewards reward types, as
+# RewardPredictor does. One step's branch value then lies within
+# +/- reward_pixels * (negative_positive_tradeoff + num_rewards - 1), so no
+# branch can gain more than twice that on another in a step
+def admissible_prune_bound(reward_pixels, num_rewards, negative_positive_tradeoff=10.0):
+    return 2.0 * reward_pixels * (abs(negative_positive_tradeoff) + num_rewards - 1)
+
+
+# Memoizes expand_beam over binary root states, in a bounded LRU table keyed on
+# the bit-packed root state and the expansion settings. Building the key copies
+# the root to the host once per expansion; cached beams stay on the device.
+# Only identical computations are reused: Transition must be deterministic, ie.
+# in eval mode, where its output is thresholded to exact 0/1 maps
+class TranspositionTable():
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The key of root state z under the given settings, or None if z is not binary,
+    # eg. a freshly encoded state
+    def key(self, z, *settings):
+        z = z.detach().float().cpu().numpy()
+        if not ((z == 0) | (z == 1)).all():
+            return None
+        return (np.packbits(z > 0.5).tobytes(),) + settings
+
+    def lookup(self, key):
+        beam = self.entries.get(key)
+        if beam is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return beam
+
+    def insert(self, key, beam):
+        self.entries[key] = beam
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+# One transition and reward prediction for a batch of states
+def simulate_step(z, actions, transition, reward_predictor):
+    z = transition(z, actions)
+    return z, reward_predictor(z)
+
+
+def rollout_actions(rollout_policy, num_actions, beam_width, device):
+    if rollout_policy == 'noop':
+        return torch.zeros(beam_width, dtype=torch.long, device=device)
+    elif rollout_policy == 'random':
+        return torch.randint(num_actions, (beam_width,), device=device)
+    raise ValueError('Unknown rollout policy {}'.format(rollout_policy))
+
+
+# Builds the full beam from z: branches on every first action and on the next
+# lookahead actions, then follows rollout_policy for the rest of the rollout.
+# The whole num_actions ** (lookahead + 1) beam advances together, one
+# transition per step; branches share the steps before they split
+# With a deadline (in time.time() seconds), the rollout deepens one step at a
+# time and stops before a step that would not finish in time. The beam may
+# then be shallower than rollout_depth, and its action values are the best
+# found at the depth reached; the first action is always taken
+# With prune_bound, branch-and-bound: prune_bound bounds how much value a branch
+# can gain on another per remaining step. After each step, branches trailing
+# the best one by more than prune_bound times the remaining steps can no longer
+# win and are dropped, so later steps run on a smaller batch. With an admissible
+# bound (see admissible_prune_bound) the best branch, and so the chosen action,
+# is never pruned; a smaller hand-set bound prunes more but may change it.
+# Pruned first actions get -inf action values
+# With a TranspositionTable, a binary root that was already expanded under the
+# same settings gets the same beam back without simulating it again. Only
+# deterministic expansions are memoized: Transition in eval mode, noop rollouts
+def expand_beam(z, transition, reward_predictor, num_actions,
+                lookahead=2, rollout_depth=12, rollout_policy='noop', deadline=None,
+                table=None, prune_bound=None, negative_positive_tradeoff=10.0):
+    key = None
+    if table is not None and not transition.training and rollout_policy == 'noop':
+        key = table.key(z, num_actions, lookahead, rollout_depth, prune_bound, negative_positive_tradeoff)
+        beam = table.lookup(key) if key is not None else None
+        if beam is not None:
+            return Beam(beam.actions, beam.states, beam.rewards, beam.dtype)
+
+    step_start = time.time()
+    branch_actions = torch.arange(num_actions, device=z.device)
+
+    # Take each possible first action
+    actions = branch_actions
+    z, rewards = simulate_step(z.detach().repeat(num_actions, 1, 1, 1), actions,
+                               transition, reward_predictor)
+    # Each step also records, per branch, its index among the branches of the step before
+    history = [[actions], [z.bool()], [rewards], [None]]
+    cumulative_reward = rewards
+    pruned = 0
+
+    def prune(z, cumulative_reward, remaining_steps):
+        values = branch_values(cumulative_reward, negative_positive_tradeoff)
+        survivors = (values >= values.max() - prune_bound * remaining_steps).nonzero().squeeze(1)
+        if len(survivors) < len(z):
+            # Compact the surviving branches into a smaller batch
+            for seq in history:
+                if seq[-1] is not None:
+                    seq[-1] = seq[-1][survivors]
+            z, cumulative_reward = z[survivors], cumulative_reward[survivors]
+        return z, cumulative_reward
+
+    if prune_bound is not None:
+        z, cumulative_reward = prune(z, cumulative_reward, rollout_depth)
+        pruned += num_actions - len(z)
+
+    # Starting from z, move forward in time and record the rewards
+    for t in range(rollout_depth):
+        if deadline is not None:
+            # Wait for the device to finish the last step before reading the clock
+            if z.device.type == 'cuda':
+                torch.cuda.synchronize(z.device)
+            # Stop if one more step, as slow as the last one, would miss the deadline
+            now = time.time()
+            if now + (now - step_start) > deadline:
+                break
+            step_start = now
+        parents = torch.arange(len(z), device=z.device)
+        if t < lookahead:
+            # Every branch splits, once per action
+            z = z.repeat_interleave(num_actions, dim=0)
+            parents = parents.repeat_interleave(num_actions)
+            cumulative_reward = cumulative_reward.repeat_interleave(num_actions, dim=0)
+            actions = branch_actions.repeat(len(z) // num_actions)
+        else:
+            actions = rollout_actions(rollout_policy, num_actions, len(z), z.device)
+        z, rewards = simulate_step(z, actions, transition, reward_predictor)
+        cumulative_reward = cumulative_reward + rewards
+        for seq, x in zip(history, [actions, z.bool(), rewards, parents]):
+            seq.append(x)
+
+        if prune_bound is not None:
+            width = len(z)
+            z, cumulative_reward = prune(z, cumulative_reward, rollout_depth - t - 1)
+            pruned += width - len(z)
+
+    # Follow each final branch back through its parents to gather its whole rollout
+    branch_idx = torch.arange(len(z), device=z.device)
+    branches = [[], [], []]
+    for step in reversed(list(zip(*history))):
+        for branch_seq, x in zip(branches, step):
+            branch_seq.append(x[branch_idx])
+        parents = step[-1]
+        if parents is not None:
+            branch_idx = parents[branch_idx]
+    actions, states, rewards = [torch.stack(seq[::-1], dim=1) for seq in branches]
+    beam = Beam(actions, states, rewards, z.dtype, pruned=pruned)
+    # A beam cut short by the deadline is not stored: a later expansion may go deeper
+    if key is not None and beam.depth() == rollout_depth:
+        table.insert(key, beam)
+    return beam
+
+
+# Model-predictive control that keeps its beam between control steps.
+# After an action is executed, only the branches that began with it survive.
+# If the next root state is close to what those branches predicted, each is
+# shifted forward one step and extended by one rollout step: one transition
+# per decision instead of rollout_depth. Otherwise, or with replan_threshold
+# None, the beam is rebuilt from scratch.
+# The surviving branches split over fewer actions at every reuse, down to a
+# single plan that is then followed until the prediction diverges.
+# With decision_budget (seconds), each replan is an anytime search that deepens
+# its rollouts until the budget runs out; depth holds the depth it reached.
+# A TranspositionTable, if given, memoizes replans across decisions.
+# With prune_bound, replans drop dominated branches as they go (see expand_beam)
+class RecedingHorizonPlanner():
+    def __init__(self, transition, reward_predictor, num_actions, lookahead=2,
+                 rollout_depth=12, rollout_policy='noop', negative_positive_tradeoff=10.0,
+                 replan_threshold=None, decision_budget=None, table=None, prune_bound=None):
+        self.transition = transition
+        self.reward_predictor = reward_predictor
+        self.num_actions = num_actions
+        self.lookahead = lookahead
+        self.rollout_depth = rollout_depth
+        self.rollout_policy = rollout_policy
+        self.negative_positive_tradeoff = negative_positive_tradeoff
+        self.replan_threshold = replan_threshold
+        self.decision_budget = decision_budget
+        self.table = table
+        self.prune_bound = prune_bound
+        self.pruned = 0
+        self.depth = 0
+        self.beam = None
+        self.replans = 0
+        self.reuses = 0
+
+    # Returns the value of each first action from the root state z
+    def plan(self, z):
+        deadline = None
+        if self.decision_budget is not None:
+            deadline = time.time() + self.decision_budget
+        z = z.detach()
+        if self.can_reuse(z):
+            self.extend()
+            self.reuses += 1
+        else:
+            self.beam = expand_beam(z, self.transition, self.reward_predictor, self.num_actions,
+                                    lookahead=self.lookahead, rollout_depth=self.rollout_depth,
+                                    rollout_policy=self.rollout_policy, deadline=deadline,
+                                    table=self.table, prune_bound=self.prune_bound,
+                                    negative_positive_tradeoff=self.negative_positive_tradeoff)
+            self.replans += 1
+            self.pruned += self.beam.pruned
+        self.depth = self.beam.depth()
+        return self.beam.action_values(self.num_actions, self.negative_positive_tradeoff)
+
+    # Call after executing action, before planning from the next state
+    def commit(self, action):
+        if self.beam is not None:
+            self.beam = self.beam.select(self.beam.actions[:, 0] == action)
+
+    def can_reuse(self, z):
+        if self.replan_threshold is None or self.beam is None or len(self.beam) == 0:
+            return False
+        # Surviving branches all predicted the same state after the executed action
+        predicted_z = self.beam.states[0, 0].to(z.dtype)
+        divergence = float((z[0] - predicted_z).abs().mean())
+        return divergence <= self.replan_threshold
+
+    def extend(self):
+        z = self.beam.final_states()
+        actions = rollout_actions(self.rollout_policy, self.num_actions, len(z), z.device)
+        z, rewards = simulate_step(z, actions, self.transition, self.reward_predictor)
+        self.beam = self.beam.shift(actions, z, rewards)
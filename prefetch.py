@@ -0,0 +1,75 @@
+import threading
+import queue
+import numpy as np
+import torch
+
+from utils import frames_to_float
+
+
+# Prepares training batches ahead of the training loop in background threads
+# Batch train_iter is built with horizon_fn(train_iter) timesteps, so a horizon
+# curriculum is followed exactly. Worker w builds iterations start_iter + w,
+# start_iter + w + num_workers, ... into its own queue, and get() reads the
+# queues round-robin, so batches arrive in iteration order.
+# Each batch is staged in pinned host memory and copied to the GPU with a
+# non-blocking transfer to the device. With num_batches=0, batches are built synchronously.
+# Workers call datasource.get_trajectories while the training loop may call it too,
+# eg. for evaluation, so the datasource must be safe to call from several threads.
+class BatchPrefetcher():
+    def __init__(self, datasource, batch_size, horizon_fn, start_iter, end_iter,
+                 num_batches=0, num_workers=1, device='cuda'):
+        self.datasource = datasource
+        self.batch_size = batch_size
+        self.horizon_fn = horizon_fn
+        self.start_iter = start_iter
+        self.end_iter = end_iter
+        self.num_batches = num_batches
+        self.num_workers = num_workers
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.queues = []
+        if num_batches <= 0:
+            return
+        queue_size = max(1, num_batches // num_workers)
+        for worker_idx in range(num_workers):
+            batch_queue = queue.Queue(maxsize=queue_size)
+            thread = threading.Thread(target=self.worker, args=(worker_idx, batch_queue))
+            thread.daemon = True  # hack to kill on ctrl+C
+            thread.start()
+            self.queues.append(batch_queue)
+
+    def worker(self, worker_idx, batch_queue):
+        for train_iter in range(self.start_iter + worker_idx, self.end_iter + 1, self.num_workers):
+            try:
+                batch_queue.put(self.build_batch(train_iter))
+            except Exception as e:
+                # Re-raised in the training loop by get()
+                batch_queue.put(e)
+                return
+
+    # Host-side tensors for one batch: states keep their compact frame dtype
+    def build_batch(self, train_iter):
+        states, rewards, dones, actions = self.datasource.get_trajectories(self.batch_size, self.horizon_fn(train_iter))
+        states = torch.from_numpy(np.ascontiguousarray(states))
+        rewards = torch.from_numpy(np.asarray(rewards, dtype=np.float32))
+        dones = torch.from_numpy(np.asarray(dones, dtype=np.float32))
+        actions = torch.from_numpy(np.asarray(actions, dtype=np.int64))
+        if self.pin_memory:
+            states, rewards, dones, actions = [x.pin_memory() for x in (states, rewards, dones, actions)]
+        return states, rewards, dones, actions
+
+    # Returns states, rewards, dones and integer actions on the device
+    def get(self, train_iter):
+        if self.queues:
+            batch_queue = self.queues[(train_iter - self.start_iter) % self.num_workers]
+            batch = batch_queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+        else:
+            batch = self.build_batch(train_iter)
+        states, rewards, dones, actions = batch
+        states = frames_to_float(states.to(self.device, non_blocking=True))
+        rewards = rewards.to(self.device, non_blocking=True)
+        dones = dones.to(self.device, non_blocking=True)
+        actions = actions.to(self.device, non_blocking=True)
+        return states, rewards, dones, actions
@@ -0,0 +1,269 @@
+import os
+import threading
+import multiprocessing
+import numpy as np
+
+# Simulator workers are forked, so they inherit the shared replay buffers directly
+mp = multiprocessing.get_context('fork')
+
+
+# A fixed-capacity store of episodes, shared by the replay-based datasources
+# Storage is one preallocated (capacity, max_episode_len, ...) array per field,
+# so that inserting or evicting an episode never allocates memory.
+# Episodes are written into slots in ring order: the oldest episode is evicted.
+# With shared=True, storage lives in shared memory and simulator processes can
+# write into it. Shared buffers must be given a spec: one (shape, dtype) per field.
+# With a directory, storage is a set of memory-mapped .npy files: field_N.npy for
+# each field, plus lengths.npy and counters.npy as the index. This is the same
+# fixed-capacity ring, not a growing corpus: reopening the directory in a later run
+# resumes sampling and overwriting from where it stopped, and the capacity,
+# max_episode_len and spec must match those it was created with.
+class ReplayBuffer():
+    def __init__(self, capacity, max_episode_len, spec=None, shared=False, directory=None):
+        self.capacity = capacity
+        self.max_episode_len = max_episode_len
+        self.shared = shared
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            check_stored_ring(directory, capacity, max_episode_len, spec)
+            if spec is None:
+                spec = stored_spec(directory)
+        self.lock = mp.Lock() if shared else threading.Lock()
+        # Readers waiting for episodes are woken whenever an episode is finished
+        self.cond = mp.Condition(self.lock) if shared else threading.Condition(self.lock)
+        # Episode index: the number of valid timesteps in each slot (0 for empty slots)
+        self.lengths = self.new_array('lengths', (capacity,), int)
+        # Next slot to be written, and number of finished episodes
+        self.counters = self.new_array('counters', (2,), int)
+        # Slots claimed by a simulator that has not finished its episode yet.
+        # Never stored on disk: after a restart, no episode is being written
+        self.in_flight = shared_array((capacity,), bool) if shared else np.zeros(capacity, dtype=bool)
+        # Without a spec, arrays are allocated when the first timestep arrives
+        self.fields = None
+        if spec is not None:
+            self.allocate(spec)
+        elif shared:
+            raise ValueError('A shared ReplayBuffer requires a spec')
+
+    def __len__(self):
+        return int(self.counters[1])
+
+    def new_array(self, name, shape, dtype):
+        if self.directory is not None:
+            return open_stored_array(os.path.join(self.directory, name + '.npy'), shape, dtype)
+        if self.shared:
+            return shared_array(shape, dtype)
+        return np.zeros(shape, dtype=dtype)
+
+    def allocate(self, spec):
+        self.fields = []
+        for i, (shape, dtype) in enumerate(spec):
+            shape = (self.capacity, self.max_episode_len) + tuple(shape)
+            self.fields.append(self.new_array('field_{}'.format(i), shape, dtype))
+
+    # Claim the oldest slot for a new episode, evicting whatever was there
+    # Slots that another simulator is still writing are skipped
+    def start_episode(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.in_flight.all())
+            slot = int(self.counters[0])
+            while self.in_flight[slot]:
+                slot = (slot + 1) % self.capacity
+            self.counters[0] = (slot + 1) % self.capacity
+            self.in_flight[slot] = True
+            if self.lengths[slot] > 0:
+                self.counters[1] -= 1
+            self.lengths[slot] = 0
+        return slot
+
+    # Write one timestep (a tuple of values, one per field) directly into storage
+    def write_timestep(self, slot, t, timestep):
+        if self.fields is None:
+            self.allocate(timestep_spec(timestep))
+        for field, value in zip(self.fields, timestep):
+            field[slot, t] = value
+
+    # The episode becomes visible to readers only once it is finished
+    def finish_episode(self, slot, length):
+        with self.cond:
+            # Finished episodes count only once, as the number of non-empty slots
+            if self.lengths[slot] == 0 and length > 0:
+                self.counters[1] += 1
+            self.lengths[slot] = length
+            self.in_flight[slot] = False
+            if self.directory is not None:
+                self.lengths.flush()
+                self.counters.flush()
+            self.cond.notify_all()
+
+    # Block until at least min_episodes are available, returns False on timeout
+    def wait_for_episodes(self, min_episodes, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self) >= min_episodes, timeout)
+
+    # Insert a complete episode: a tuple of (T, ...) arrays, one per field
+    def add_episode(self, episode):
+        length = min(len(episode[0]), self.max_episode_len)
+        slot = self.start_episode()
+        for t in range(length):
+            self.write_timestep(slot, t, [field[t] for field in episode])
+        self.finish_episode(slot, length)
+
+    # Sample batch_size clips of length timesteps, as one (batch_size, timesteps, ...)
+    # array per field followed by a (batch_size, timesteps) array of done flags
+    # A clip that reaches the end of its episode continues into another random episode
+    def sample(self, batch_size, timesteps, random_start=True):
+        slots = np.zeros((batch_size, timesteps), dtype=int)
+        offsets = np.zeros((batch_size, timesteps), dtype=int)
+        dones = np.zeros((batch_size, timesteps), dtype=bool)
+        t = np.arange(timesteps)
+        with self.cond:
+            # Clip starts are drawn from [0, length - 3), so shorter episodes are skipped
+            candidates = np.flatnonzero(self.lengths > 3)
+            filled = np.zeros(batch_size, dtype=int)
+            rows = np.arange(batch_size)
+            while len(rows) > 0:
+                selected = np.random.choice(candidates, size=len(rows))
+                lengths = self.lengths[selected]
+                if random_start:
+                    start = np.random.randint(0, lengths - 3)
+                else:
+                    start = np.zeros(len(rows), dtype=int)
+                # As before, the last timestep of an episode is never part of a clip
+                duration = np.minimum(timesteps - filled[rows], lengths - 1 - start)
+                in_clip = (t >= filled[rows, None]) & (t < (filled[rows] + duration)[:, None])
+                clip_idx, t_idx = np.nonzero(in_clip)
+                slots[rows[clip_idx], t_idx] = selected[clip_idx]
+                offsets[rows[clip_idx], t_idx] = (start - filled[rows])[clip_idx] + t_idx
+                dones[rows, filled[rows] + duration - 1] = True
+                filled[rows] += duration
+                rows = rows[filled[rows] < timesteps]
+            # Gather every clip of every field with a single fancy-indexing operation
+            batch = tuple(field[slots, offsets] for field in self.fields)
+        return batch + (dones,)
+
+
+# Keeps the number of sampled clips per inserted episode close to samples_per_insert
+# Simulators call await_insert() before each episode and block while they are more
+# than error_buffer samples ahead of the target ratio; the training loop calls
+# await_sample() before each batch and blocks while it is that far behind.
+# Both sides run freely until min_inserts episodes have been inserted.
+class RateLimiter():
+    def __init__(self, samples_per_insert, min_inserts=1, error_buffer=None, shared=False):
+        self.samples_per_insert = samples_per_insert
+        self.min_inserts = min_inserts
+        if error_buffer is None:
+            error_buffer = 10 * samples_per_insert
+        self.error_buffer = error_buffer
+        self.cond = mp.Condition() if shared else threading.Condition()
+        # Number of episodes inserted, and number of clips sampled
+        self.counters = shared_array(2, int) if shared else np.zeros(2, dtype=int)
+
+    # Positive when simulators are ahead of the target ratio, negative when behind
+    def excess_samples(self):
+        inserts, samples = self.counters
+        return inserts * self.samples_per_insert - samples
+
+    def can_insert(self):
+        return self.counters[0] < self.min_inserts or self.excess_samples() <= self.error_buffer
+
+    def can_sample(self):
+        return self.counters[0] < self.min_inserts or self.excess_samples() >= -self.error_buffer
+
+    def await_insert(self):
+        with self.cond:
+            self.cond.wait_for(self.can_insert)
+            self.counters[0] += 1
+            self.cond.notify_all()
+
+    def await_sample(self, num_samples):
+        with self.cond:
+            self.cond.wait_for(self.can_sample)
+            self.counters[1] += num_samples
+            self.cond.notify_all()
+
+
+# The (shape, dtype) of each field of a timestep, for allocating a ReplayBuffer
+def timestep_spec(timestep):
+    spec = []
+    for value in timestep:
+        value = np.asarray(value)
+        spec.append((value.shape, value.dtype))
+    return spec
+
+
+# Frames are stored as uint8: float pixels in [0, 1] are quantized to 0-255
+def quantize_frame(frame):
+    frame = np.asarray(frame)
+    if frame.dtype == np.uint8:
+        return frame
+    return (np.clip(frame, 0, 1) * 255).round().astype(np.uint8)
+
+
+# The spec of the fields stored in a ReplayBuffer directory, or None if it is empty
+def stored_spec(directory):
+    spec = []
+    while True:
+        filename = os.path.join(directory, 'field_{}.npy'.format(len(spec)))
+        if not os.path.exists(filename):
+            break
+        array = np.load(filename, mmap_mode='r')
+        spec.append((array.shape[2:], array.dtype))
+    return spec or None
+
+
+# A ReplayBuffer directory can only be reopened as the ring it was created as
+def check_stored_ring(directory, capacity, max_episode_len, spec=None):
+    filename = os.path.join(directory, 'lengths.npy')
+    if os.path.exists(filename):
+        stored_capacity = np.load(filename, mmap_mode='r').shape[0]
+        if stored_capacity != capacity:
+            msg = 'Replay ring {} holds {} episodes, cannot reopen it with capacity {}'.format(
+                directory, stored_capacity, capacity)
+            raise ValueError(msg)
+    filename = os.path.join(directory, 'field_0.npy')
+    if os.path.exists(filename):
+        stored_len = np.load(filename, mmap_mode='r').shape[1]
+        if stored_len != max_episode_len:
+            msg = 'Replay ring {} holds episodes of up to {} timesteps, cannot reopen it with max_episode_len {}'.format(
+                directory, stored_len, max_episode_len)
+            raise ValueError(msg)
+    stored = stored_spec(directory)
+    if spec is not None and stored is not None:
+        spec = [(tuple(shape), np.dtype(dtype)) for shape, dtype in spec]
+        if stored != spec:
+            msg = 'Replay ring {} stores timesteps with spec {}, cannot reopen it with spec {}'.format(
+                directory, stored, spec)
+            raise ValueError(msg)
+
+
+# Open a memory-mapped .npy file, creating it if it does not exist yet
+def open_stored_array(filename, shape, dtype):
+    if not os.path.exists(filename):
+        return np.lib.format.open_memmap(filename, mode='w+', shape=shape, dtype=dtype)
+    array = np.load(filename, mmap_mode='r+')
+    if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+        msg = 'Stored replay array {} has shape {} dtype {}, expected shape {} dtype {}'.format(
+            filename, array.shape, array.dtype, tuple(shape), np.dtype(dtype))
+        raise ValueError(msg)
+    return array
+
+
+# A numpy array backed by shared memory, visible to forked child processes
+def shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = mp.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+# Run target(worker_idx) in each of num_workers daemon simulator processes
+def start_simulator_processes(target, num_workers):
+    workers = []
+    for worker_idx in range(num_workers):
+        worker = mp.Process(target=target, args=(worker_idx,))
+        worker.daemon = True  # hack to kill on ctrl+C
+        worker.start()
+        workers.append(worker)
+    return workers
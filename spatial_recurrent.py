@@ -47,17 +47,17 @@ class CSRN(nn.Module):
         batch_size, channels, height, width = x.shape
         assert channels == self.channels
         # x.shape: (batch, channels, height, width)
-        context_above = torch.zeros((batch_size, self.rnn_out, height, width)).cuda()
-        context_below = torch.zeros((batch_size, self.rnn_out, height, width)).cuda()
-        context_left = torch.zeros((batch_size, self.rnn_out, height, width)).cuda()
-        context_right = torch.zeros((batch_size, self.rnn_out, height, width)).cuda()
+        context_above = torch.zeros((batch_size, self.rnn_out, height, width), device=x.device)
+        context_below = torch.zeros((batch_size, self.rnn_out, height, width), device=x.device)
+        context_left = torch.zeros((batch_size, self.rnn_out, height, width), device=x.device)
+        context_right = torch.zeros((batch_size, self.rnn_out, height, width), device=x.device)
 
         # For each row, top to bottom:
         #  Take the output of the RNN on the previous row
         #  Apply a 1D convolution to that row (so activations spread like a cone)
         #  Feed the convolved activations back into the RNN
-        rnn_state = torch.zeros((1, batch_size * width, self.rnn_out)).cuda()
-        rnn_cx = torch.zeros((1, batch_size * width, self.rnn_out)).cuda()
+        rnn_state = torch.zeros((1, batch_size * width, self.rnn_out), device=x.device)
+        rnn_cx = torch.zeros((1, batch_size * width, self.rnn_out), device=x.device)
         for i in range(height):
             pixel_row = x[:, :, i, :]
             pixel_row = pixel_row.permute(0, 2, 1).contiguous()
@@ -71,7 +71,7 @@ class CSRN(nn.Module):
             rnn_state = conv_out.permute(0, 2, 1).contiguous()
             rnn_state = rnn_state.view(1, batch_size * width, self.rnn_in)
 
-        rnn_state = torch.zeros((1, batch_size * width, self.rnn_out)).cuda()
+        rnn_state = torch.zeros((1, batch_size * width, self.rnn_out), device=x.device)
         for i in reversed(range(height)):
             pixel_row = x[:, :, i, :]
             pixel_row = pixel_row.permute(0, 2, 1).contiguous()
@@ -85,7 +85,7 @@ class CSRN(nn.Module):
             rnn_state = conv_out.permute(0, 2, 1).contiguous()
             rnn_state = rnn_state.view(1, batch_size * width, self.rnn_out)
 
-        rnn_state = torch.zeros((1, batch_size * height, self.rnn_out)).cuda()
+        rnn_state = torch.zeros((1, batch_size * height, self.rnn_out), device=x.device)
         for i in range(width):
             pixel_col = x[:, :, :, i]
             pixel_col = pixel_col.permute(0, 2, 1).contiguous()
@@ -99,7 +99,7 @@ class CSRN(nn.Module):
             rnn_state = conv_out.permute(0, 2, 1).contiguous()
             rnn_state = rnn_state.view(1, batch_size * height, self.rnn_out)
 
-        rnn_state = torch.zeros((1, batch_size * height, self.rnn_out)).cuda()
+        rnn_state = torch.zeros((1, batch_size * height, self.rnn_out), device=x.device)
         for i in reversed(range(width)):
             pixel_col = x[:, :, :, i]
             pixel_col = pixel_col.permute(0, 2, 1).contiguous()
@@ -11,28 +11,48 @@ def l2normalize(v, eps=1e-12):
     return v / (v.norm() + eps)
 
 
+# The power iteration and the normalized weight are computed once per update of
+# the weight, not on every forward: both are cached and keyed on the weight's
+# version counter, which optimizer steps and load_state_dict bump in place.
+# The normalized weight is also keyed on grad mode, so a weight computed under
+# no_grad is never used for training, and it is dropped once backward has
+# consumed its graph.
 class SpectralNorm(nn.Module):
     def __init__(self, module, name='weight', power_iterations=1):
         super(SpectralNorm, self).__init__()
         self.module = module
         self.name = name
         self.power_iterations = power_iterations
+        self._sigma_key = None
+        self._weight_key = None
         if not self._made_params():
             self._make_params()
+        w = getattr(self.module, self.name + "_bar")
+        w.register_hook(self._release_weight)
+
+    def _release_weight(self, grad):
+        self._weight_key = None
 
     def _update_u_v(self):
         u = getattr(self.module, self.name + "_u")
         v = getattr(self.module, self.name + "_v")
         w = getattr(self.module, self.name + "_bar")
 
-        height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(torch.mv(torch.t(w.view(height,-1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height,-1).data, v.data))
+        version = (w._version, w.data_ptr())
+        if self._weight_key == version + (torch.is_grad_enabled(),):
+            return
 
-        # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
-        sigma = u.dot(w.view(height, -1).mv(v))
+        height = w.data.shape[0]
+        if self._sigma_key != version:
+            for _ in range(self.power_iterations):
+                v.data = l2normalize(torch.mv(torch.t(w.reshape(height, -1).data), u.data))
+                u.data = l2normalize(torch.mv(w.reshape(height, -1).data, v.data))
+            self._sigma_key = version
+
+        # sigma = torch.dot(u.data, torch.mv(w.reshape(height, -1).data, v.data))
+        sigma = u.dot(w.reshape(height, -1).mv(v))
         setattr(self.module, self.name, w / sigma.expand_as(w))
+        self._weight_key = version + (torch.is_grad_enabled(),)
 
     def _made_params(self):
         try:
@@ -48,7 +68,7 @@ class SpectralNorm(nn.Module):
         w = getattr(self.module, self.name)
 
         height = w.data.shape[0]
-        width = w.view(height, -1).data.shape[1]
+        width = w.reshape(height, -1).data.shape[1]
 
         u = Parameter(w.data.new(height).normal_(0, 1), requires_grad=False)
         v = Parameter(w.data.new(width).normal_(0, 1), requires_grad=False)
@@ -63,6 +83,41 @@ class SpectralNorm(nn.Module):
         self.module.register_parameter(self.name + "_bar", w_bar)
 
 
+    # The spectrally-normalized weight, as used by forward()
+    def normalized_weight(self):
+        self._update_u_v()
+        return getattr(self.module, self.name)
+
     def forward(self, *args):
         self._update_u_v()
         return self.module.forward(*args)
+
+    # The wrapped module with the current normalized weight baked in as a plain parameter
+    def frozen(self):
+        weight = self.normalized_weight().detach().clone()
+        for suffix in ('_u', '_v', '_bar'):
+            del self.module._parameters[self.name + suffix]
+        delattr(self.module, self.name)
+        self.module.register_parameter(self.name, Parameter(weight, requires_grad=False))
+        return self.module
+
+
+# Replace every SpectralNorm in model with its frozen module, for evaluation only
+# The frozen model no longer trains, and its state_dict has plain weights
+def freeze_spectral_norm(model):
+    for name, child in model.named_children():
+        if isinstance(child, SpectralNorm):
+            setattr(model, name, child.frozen())
+        else:
+            freeze_spectral_norm(child)
+    return model
+
+
+# Compute and cache the normalized weight of every SpectralNorm in model for the
+# current weights and grad mode, so that later forwards reuse the same tensor
+# Gradient checkpointing needs this: a recomputed segment must not rebuild the weight
+def precompute_spectral_norm(model):
+    for module in model.modules():
+        if isinstance(module, SpectralNorm):
+            module.normalized_weight()
+    return model
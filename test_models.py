@@ -0,0 +1,54 @@
+import torch
+import torch.nn.functional as F
+
+from models import Transition
+
+
+LATENT_DIM = 6
+NUM_ACTIONS = 5
+
+
+def test_conv1_indexed_matches_onehot_concat():
+    torch.manual_seed(0)
+    transition = Transition(LATENT_DIM, NUM_ACTIONS, device='cpu').eval()
+    # Non-square maps, so that swapped padding or size axes would not line up
+    z = (torch.rand(NUM_ACTIONS, LATENT_DIM, 7, 9) > 0.5).float()
+    actions = torch.arange(NUM_ACTIONS)
+    with torch.no_grad():
+        # The original path: broadcast the one-hot action across the map and concatenate
+        onehot = F.one_hot(actions, NUM_ACTIONS).float()
+        onehot_map = onehot.unsqueeze(-1).unsqueeze(-1).repeat(1, 1, 7, 9)
+        expected = transition.conv1(torch.cat([z, onehot_map], dim=1))
+        x = transition.conv1_indexed(z, actions)
+    assert x.shape == expected.shape == (NUM_ACTIONS, 128, 7, 9)
+    for action in range(NUM_ACTIONS):
+        assert torch.allclose(x[action], expected[action], atol=1e-5)
+
+
+def test_forward_accepts_indices_or_onehot():
+    torch.manual_seed(0)
+    transition = Transition(LATENT_DIM, NUM_ACTIONS, device='cpu').eval()
+    z = (torch.rand(NUM_ACTIONS, LATENT_DIM, 8, 8) > 0.5).float()
+    actions = torch.arange(NUM_ACTIONS)
+    with torch.no_grad():
+        dense = transition(z, F.one_hot(actions, NUM_ACTIONS).float(), return_all=True)
+        indexed = transition(z, actions, return_all=True)
+    # Every activation of the U-net agrees, up to float rounding
+    for x, y in zip(indexed[:-1], dense[:-1]):
+        assert torch.allclose(x, y, atol=1e-5)
+    assert indexed[-1].shape == z.shape
+
+
+def test_replayed_sample_matches_the_sampled_step():
+    torch.manual_seed(0)
+    transition = Transition(LATENT_DIM, NUM_ACTIONS, device='cpu').train()
+    z = (torch.rand(NUM_ACTIONS, LATENT_DIM, 8, 8) > 0.5).float()
+    actions = torch.arange(NUM_ACTIONS)
+    params = [p for p in transition.parameters() if p.requires_grad]
+    sampled = transition(z, actions)
+    expected_grads = torch.autograd.grad(sampled.sum(), params)
+    # Re-simulating the step with its sample gives the same state and the same gradients
+    replayed = transition(z, actions, sample=sampled.detach())
+    assert torch.equal(replayed, sampled)
+    for grad, expected in zip(torch.autograd.grad(replayed.sum(), params), expected_grads):
+        assert torch.allclose(grad, expected)
@@ -0,0 +1,37 @@
+import numpy as np
+from gym.spaces.discrete import Discrete
+
+from multi_env import MultiEnvironment
+
+
+# Its first reward is the int 0, later ones are fractional
+class CountingEnv():
+    def __init__(self):
+        self.action_space = Discrete(2)
+        self.reset()
+
+    def reset(self):
+        self.t = 0
+        return np.zeros((1, 2, 2), dtype=bool)
+
+    def step(self, action):
+        reward = 0 if self.t == 0 else 0.5 * (action + 1)
+        self.t += 1
+        return np.ones((1, 2, 2), dtype=bool), reward, False, {}
+
+
+def test_rewards_are_float32():
+    with MultiEnvironment([CountingEnv() for _ in range(4)], num_workers=2) as envs:
+        states, rewards, dones, infos = envs.step([0, 1, 0, 1])
+        assert rewards.dtype == np.float32 and rewards.tolist() == [0, 0, 0, 0]
+        states, rewards, dones, infos = envs.step([0, 1, 0, 1])
+        assert rewards.tolist() == [0.5, 1.0, 0.5, 1.0]
+        assert states.dtype == bool and states.shape == (4, 1, 2, 2)
+
+
+def test_close():
+    envs = MultiEnvironment([CountingEnv() for _ in range(2)])
+    envs.close()
+    # Closing twice, eg. explicitly and then at exit, is harmless
+    envs.close()
+    assert envs.closed
@@ -0,0 +1,158 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from planner import Beam, expand_beam, RecedingHorizonPlanner, TranspositionTable, admissible_prune_bound
+
+
+NUM_ACTIONS = 3
+LATENT_DIM = 4
+SIZE = 5
+
+
+# Shifts every latent map one cell right per step, and switches on the
+# latent factor named by the action: deterministic and binary like Transition in eval mode
+class ToyTransition(nn.Module):
+    def forward(self, z, actions):
+        z = torch.roll(z, 1, dims=3).clone()
+        z[torch.arange(len(z)), actions] = 1
+        return (z > 0.5).float()
+
+
+# Positive reward for factor 1, negative reward for factor 2
+class ToyRewardPredictor(nn.Module):
+    def forward(self, z):
+        return torch.stack([z[:, 1].mean(dim=(1, 2)), -z[:, 2].mean(dim=(1, 2))], dim=1)
+
+
+def toy_models():
+    return ToyTransition().eval(), ToyRewardPredictor().eval()
+
+
+def root_state():
+    return torch.zeros(1, LATENT_DIM, SIZE, SIZE)
+
+
+def test_action_values():
+    actions = torch.tensor([[0], [0], [2]])
+    states = torch.zeros(3, 1, LATENT_DIM, SIZE, SIZE, dtype=torch.bool)
+    rewards = torch.tensor([[[1., 0.]], [[2., 0.]], [[1., -1.]]])
+    values = Beam(actions, states, rewards).action_values(NUM_ACTIONS, negative_positive_tradeoff=10.0)
+    assert values.tolist() == [20., -float('inf'), 9.]
+
+
+def test_expand_beam_shapes():
+    transition, reward_predictor = toy_models()
+    beam = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                       lookahead=2, rollout_depth=4)
+    assert len(beam) == NUM_ACTIONS ** 3
+    assert beam.states.shape == (NUM_ACTIONS ** 3, 5, LATENT_DIM, SIZE, SIZE)
+    assert beam.rewards.shape == (NUM_ACTIONS ** 3, 5, 2)
+    # Every combination of the first three actions appears once, then noop rollouts
+    assert len(set(map(tuple, beam.actions[:, :3].tolist()))) == NUM_ACTIONS ** 3
+    assert (beam.actions[:, 3:] == 0).all()
+    values = beam.action_values(NUM_ACTIONS)
+    assert values.argmax().item() == 1
+
+
+def test_planner_step():
+    transition, reward_predictor = toy_models()
+    planner = RecedingHorizonPlanner(transition, reward_predictor, NUM_ACTIONS,
+                                     lookahead=1, rollout_depth=3, replan_threshold=0.)
+    z = root_state()
+    values = planner.plan(z)
+    assert values.shape == (NUM_ACTIONS,)
+    assert planner.replans == 1
+    action = int(values.argmax())
+    assert action == 1
+
+    # The next root state is exactly the one predicted, so the beam is reused
+    planner.commit(action)
+    z = transition(z, torch.tensor([action]))
+    values = planner.plan(z)
+    assert planner.reuses == 1
+    assert isinstance(planner.beam, Beam) and len(planner.beam) == NUM_ACTIONS
+
+
+def test_expand_beam_transposition_table():
+    transition, reward_predictor = toy_models()
+    table = TranspositionTable()
+    beam = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                       lookahead=2, rollout_depth=4)
+    first = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                        lookahead=2, rollout_depth=4, table=table)
+    cached = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                         lookahead=2, rollout_depth=4, table=table)
+    assert (table.misses, table.hits, len(table)) == (1, 1, 1)
+    # A memoized expansion is the same computation as one without a table
+    for result in (first, cached):
+        assert torch.equal(beam.actions, result.actions)
+        assert torch.equal(beam.states, result.states)
+        assert torch.equal(beam.rewards, result.rewards)
+
+    # Other settings, stochastic transitions and non-binary roots are not reused
+    expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                lookahead=1, rollout_depth=4, table=table)
+    assert (table.misses, table.hits) == (2, 1)
+    transition.train()
+    expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                lookahead=2, rollout_depth=4, table=table)
+    transition.eval()
+    expand_beam(root_state() + 0.25, transition, reward_predictor, NUM_ACTIONS,
+                lookahead=2, rollout_depth=4, table=table)
+    assert (table.misses, table.hits, len(table)) == (2, 1, 2)
+
+
+def test_expand_beam_pruning_keeps_best_branch():
+    transition, reward_predictor = toy_models()
+    full = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                       lookahead=2, rollout_depth=4)
+    pruned = expand_beam(root_state(), transition, reward_predictor, NUM_ACTIONS,
+                         lookahead=2, rollout_depth=4, prune_bound=0.)
+    assert pruned.pruned > 0
+    assert len(pruned) < len(full)
+    assert pruned.action_values(NUM_ACTIONS).max() == full.action_values(NUM_ACTIONS).max()
+
+
+# A random binary transition, to compare planning with and without pruning
+class RandomTransition(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(LATENT_DIM + NUM_ACTIONS, LATENT_DIM, 3, padding=1, padding_mode='circular')
+
+    def forward(self, z, actions):
+        onehot = F.one_hot(actions, NUM_ACTIONS).float()[:, :, None, None].expand(-1, -1, SIZE, SIZE)
+        return (self.conv(torch.cat([z, onehot], dim=1)) > 0).float()
+
+
+# Sums a single-pixel reward map in [-1, 1] for each of two reward types, like RewardPredictor
+class OnePixelRewardPredictor(nn.Module):
+    def forward(self, z, visualize=False):
+        reward_map = z[:, :2].mean(dim=(2, 3), keepdim=True) * 2 - 1
+        if visualize:
+            return reward_map.sum(-1).sum(-1), reward_map
+        return reward_map.sum(-1).sum(-1)
+
+
+def test_admissible_pruning_keeps_the_chosen_action():
+    reward_predictor = OnePixelRewardPredictor().eval()
+    tradeoff = 1.0
+    prune_bound = admissible_prune_bound(1, 2, tradeoff)
+    assert prune_bound == 4.0
+    total_pruned = 0
+    for seed in range(10):
+        torch.manual_seed(seed)
+        transition = RandomTransition().eval()
+        z = (torch.rand(1, LATENT_DIM, SIZE, SIZE) > 0.5).float()
+        with torch.no_grad():
+            full = expand_beam(z, transition, reward_predictor, NUM_ACTIONS, lookahead=2,
+                               rollout_depth=4, negative_positive_tradeoff=tradeoff)
+            pruned = expand_beam(z, transition, reward_predictor, NUM_ACTIONS, lookahead=2,
+                                 rollout_depth=4, prune_bound=prune_bound,
+                                 negative_positive_tradeoff=tradeoff)
+        full_values = full.action_values(NUM_ACTIONS, tradeoff)
+        pruned_values = pruned.action_values(NUM_ACTIONS, tradeoff)
+        assert pruned_values.argmax() == full_values.argmax()
+        assert pruned_values.max() == full_values.max()
+        total_pruned += pruned.pruned
+    assert total_pruned > 0
@@ -0,0 +1,52 @@
+import time
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from prefetch import BatchPrefetcher
+
+
+# Builds each batch after a random delay, so workers finish out of order.
+# The horizon of a batch identifies the iteration it was built for
+class SlowDatasource():
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+
+    def get_trajectories(self, batch_size, timesteps):
+        time.sleep(random.random() * 0.01)
+        if timesteps == self.fail_at:
+            raise ValueError('Simulator failed at horizon {}'.format(timesteps))
+        states = np.full((batch_size, timesteps, 1, 4, 4), 255, dtype=np.uint8)
+        rewards = np.zeros((batch_size, timesteps, 1))
+        dones = np.zeros((batch_size, timesteps), dtype=bool)
+        actions = np.full((batch_size, timesteps), timesteps)
+        return states, rewards, dones, actions
+
+
+def horizon(train_iter):
+    return train_iter + 1
+
+
+@pytest.mark.parametrize('num_batches,num_workers', [(0, 1), (1, 1), (2, 1), (4, 3)])
+def test_batches_arrive_in_iteration_order(num_batches, num_workers):
+    start_iter, end_iter = 5, 20
+    prefetcher = BatchPrefetcher(SlowDatasource(), 2, horizon, start_iter, end_iter,
+                                 num_batches=num_batches, num_workers=num_workers, device='cpu')
+    for train_iter in range(start_iter, end_iter + 1):
+        states, rewards, dones, actions = prefetcher.get(train_iter)
+        assert states.shape == (2, horizon(train_iter), 1, 4, 4)
+        assert (actions == horizon(train_iter)).all()
+        # Frames reach the device as uint8 and become float there
+        assert states.dtype == torch.float32 and (states == 1).all()
+        assert actions.dtype == torch.int64 and rewards.dtype == dones.dtype == torch.float32
+
+
+def test_worker_errors_are_raised_by_get():
+    prefetcher = BatchPrefetcher(SlowDatasource(fail_at=horizon(3)), 2, horizon, 0, 10,
+                                 num_batches=2, num_workers=2, device='cpu')
+    for train_iter in range(3):
+        prefetcher.get(train_iter)
+    with pytest.raises(ValueError):
+        prefetcher.get(3)
@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+from replay_buffer import ReplayBuffer
+
+
+EPISODE_LENGTHS = [12, 5, 30, 8]
+NUM_ACTIONS = 5
+
+
+# Each timestep's state encodes its (episode, t), so clips can be traced back
+def make_episode(episode_idx, length):
+    states = episode_idx * 1000 + np.arange(length)
+    rewards = np.stack([states, -states], axis=1).astype(float)
+    actions = states % NUM_ACTIONS
+    return states, rewards, actions
+
+
+def make_buffer(lengths=EPISODE_LENGTHS, max_episode_len=30):
+    replay_buffer = ReplayBuffer(len(lengths), max_episode_len)
+    for episode_idx, length in enumerate(lengths):
+        replay_buffer.add_episode(make_episode(episode_idx, length))
+    return replay_buffer
+
+
+# The per-clip loop that ReplayBuffer.sample replaced, over a list of episodes
+def naive_sample(episodes, batch_size, timesteps, random_start=True):
+    states_batch, rewards_batch, actions_batch, dones_batch = [], [], [], []
+    for _ in range(batch_size):
+        states, rewards, actions, dones = [], [], [], []
+        timesteps_remaining = timesteps
+        while timesteps_remaining > 0:
+            selected_states, selected_rewards, selected_actions = episodes[np.random.randint(len(episodes))]
+            if random_start:
+                start_idx = np.random.randint(0, len(selected_states) - 3)
+            else:
+                start_idx = 0
+            end_idx = min(start_idx + timesteps_remaining, len(selected_states) - 1)
+            duration = end_idx - start_idx
+            states.extend(selected_states[start_idx:end_idx])
+            rewards.extend(selected_rewards[start_idx:end_idx])
+            actions.extend(selected_actions[start_idx:end_idx])
+            dones.extend([False for _ in range(duration - 1)] + [True])
+            timesteps_remaining -= duration
+        states_batch.append(np.array(states))
+        rewards_batch.append(np.array(rewards))
+        actions_batch.append(np.array(actions))
+        dones_batch.append(np.array(dones))
+    return np.array(states_batch), np.array(rewards_batch), np.array(actions_batch), np.array(dones_batch)
+
+
+# Check that every clip is made of segments the naive sampler could have drawn
+def check_clips(states, rewards, actions, dones, lengths, random_start=True):
+    assert (rewards[..., 0] == states).all() and (rewards[..., 1] == -states).all()
+    assert (actions == states % NUM_ACTIONS).all()
+    for clip_states, clip_dones in zip(states, dones):
+        assert clip_dones[-1]
+        segment_ends = list(np.flatnonzero(clip_dones) + 1)
+        segment_starts = [0] + segment_ends[:-1]
+        for i, (start, end) in enumerate(zip(segment_starts, segment_ends)):
+            segment = clip_states[start:end]
+            episode_idx, offset = divmod(int(segment[0]), 1000)
+            length = lengths[episode_idx]
+            assert length > 3
+            if random_start:
+                assert 0 <= offset < length - 3
+            else:
+                assert offset == 0
+            assert (segment == segment[0] + np.arange(len(segment))).all()
+            # The last timestep of an episode is never part of a clip
+            assert offset + len(segment) <= length - 1
+            if i < len(segment_ends) - 1:
+                # Only running out of episode starts a new segment
+                assert offset + len(segment) == length - 1
+
+
+def test_sample_matches_naive_sampler_without_random_start():
+    # With one episode and fixed starts, both samplers are deterministic
+    lengths = [9]
+    replay_buffer = make_buffer(lengths)
+    episodes = [make_episode(0, 9)]
+    for timesteps in [1, 4, 8, 20]:
+        expected = naive_sample(episodes, 3, timesteps, random_start=False)
+        states, rewards, actions, dones = replay_buffer.sample(3, timesteps, random_start=False)
+        for x, y in zip((states, rewards, actions, dones), expected):
+            assert x.shape == y.shape
+            assert (x == y).all()
+
+
+def test_sample_clips_are_valid():
+    np.random.seed(0)
+    replay_buffer = make_buffer()
+    for random_start in [True, False]:
+        for timesteps in [1, 10, 40]:
+            states, rewards, actions, dones = replay_buffer.sample(16, timesteps, random_start)
+            assert states.shape == (16, timesteps)
+            assert rewards.shape == (16, timesteps, 2)
+            assert dones.shape == (16, timesteps) and dones.dtype == bool
+            check_clips(states, rewards, actions, dones, EPISODE_LENGTHS, random_start)
+
+
+def test_sample_distribution_matches_naive_sampler():
+    # The naive sampler picks a uniform episode, then a uniform start in [0, length - 3)
+    np.random.seed(0)
+    replay_buffer = make_buffer()
+    num_samples = 20000
+    states = replay_buffer.sample(num_samples, 1)[0]
+    values, counts = np.unique(states, return_counts=True)
+    expected_values = [i * 1000 + t for i, length in enumerate(EPISODE_LENGTHS) for t in range(length - 3)]
+    assert values.tolist() == expected_values
+    for value, count in zip(values, counts):
+        p = 1 / len(EPISODE_LENGTHS) / (EPISODE_LENGTHS[value // 1000] - 3)
+        assert abs(count / num_samples - p) < 5 * np.sqrt(p / num_samples)
+
+
+def test_start_episode_skips_slots_in_flight():
+    replay_buffer = make_buffer(lengths=[6, 6, 6])
+    # Two simulators claim slots: neither gets the other's unfinished slot
+    first = replay_buffer.start_episode()
+    second = replay_buffer.start_episode()
+    assert first != second
+    assert len(replay_buffer) == 1
+    replay_buffer.finish_episode(second, 6)
+    third = replay_buffer.start_episode()
+    replay_buffer.finish_episode(third, 6)
+    # The ring has come back around to the first slot, which is still being written
+    fourth = replay_buffer.start_episode()
+    assert fourth not in (first, third)
+    replay_buffer.finish_episode(first, 6)
+    replay_buffer.finish_episode(fourth, 6)
+    # Each slot holds one finished episode, counted once
+    assert len(replay_buffer) == 3
+    assert not replay_buffer.in_flight.any()
+
+
+def test_directory_reopens_as_the_same_ring(tmp_path):
+    directory = str(tmp_path)
+    replay_buffer = ReplayBuffer(4, 30, directory=directory)
+    for episode_idx, length in enumerate(EPISODE_LENGTHS):
+        replay_buffer.add_episode(make_episode(episode_idx, length))
+    del replay_buffer
+    # A later run picks up the stored episodes, and evicts the oldest one first
+    replay_buffer = ReplayBuffer(4, 30, directory=directory)
+    assert len(replay_buffer) == 4
+    replay_buffer.add_episode(make_episode(0, 20))
+    assert len(replay_buffer) == 4 and replay_buffer.lengths.tolist() == [20, 5, 30, 8]
+    del replay_buffer
+    # The ring cannot be reopened with a different layout
+    with pytest.raises(ValueError, match='capacity'):
+        ReplayBuffer(8, 30, directory=directory)
+    with pytest.raises(ValueError, match='max_episode_len'):
+        ReplayBuffer(4, 40, directory=directory)
+    with pytest.raises(ValueError, match='spec'):
+        ReplayBuffer(4, 30, spec=[((), np.float32), ((2,), float), ((), int)], directory=directory)
@@ -1,5 +1,21 @@
+import numpy as np
 import torch
 
+
+# Frames are stored and moved as uint8 (0-255) or bool, and become float32 only on the device
+# uint8 always means pixel intensities: feature layers that are not pixels
+# (eg. SC2 unit type or one-hot planes) must be stored as bool or float
+def frames_to_tensor(frames, device='cuda'):
+    frames = torch.from_numpy(np.ascontiguousarray(frames)).to(device)
+    return frames_to_float(frames)
+
+
+def frames_to_float(frames):
+    if frames.dtype == torch.uint8:
+        return frames.float() / 255
+    return frames.float()
+
+
 def cov(m, rowvar=False):
     '''Estimate a covariance matrix given data.
 
@@ -25,6 +25,7 @@ from importlib import import_module
 datasource = import_module('envs.' + sys.argv[1])
 
 import models
+from utils import frames_to_tensor
 
 
 def main():
@@ -55,7 +56,7 @@ def main():
                 child.momentum = 0
 
     states, rewards, dones, actions = datasource.get_trajectories(batch_size, timesteps=1)
-    states = torch.Tensor(states).cuda()
+    states = frames_to_tensor(states)
 
     # Reconstruct the first timestep
     reconstructed = decoder(encoder(states[:, 0]))